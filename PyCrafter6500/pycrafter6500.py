@@ -1,8 +1,8 @@
-import usb.core
-import usb.util
-import time
 import numpy
-import sys
+
+from dlpyc900 import erle, commands, core
+from dlpyc900.sequence import Sequence
+from dlpyc900.dlp_errors import DMDerror
 
 
 ##function that converts a number into a bit string of given length
@@ -28,265 +28,55 @@ def bitstobytes(a):
 
     return bytelist
 
-##function that encodes a 8 bit numpy array matrix as a enhanced run lenght encoded string of bits
+##function that merges up to 24 binary images into a 24 bit image, of shape (1080,1920,3) with images 0-7 in the last and 16-23 in the first color
 
 def mergeimages(images):
-    mergedimage=numpy.zeros((1080,1920,3),dtype='uint8')
-
-    for i in range(len(images)):
-        if i<8:
-            mergedimage[:,:,2]=mergedimage[:,:,2]+images[i]*(2**i)
-        if i>7 and i<16:
-            mergedimage[:,:,1]=mergedimage[:,:,1]+images[i]*(2**(i-8))
-        if i>15 and i<24:
-            mergedimage[:,:,0]=mergedimage[:,:,0]+images[i]*(2**(i-16))
+    merged=erle.merge(images)
 
-    return mergedimage
+    return numpy.ascontiguousarray(merged.view('uint8').reshape(merged.shape+(4,))[:,:,2::-1])
 
-def encode(image): 
+##function that encodes a 24 bit image as enhanced run lenght encoded bytes, with the encoder of dlpyc900
 
+def encode(image):
+    image=numpy.asarray(image).astype('uint32')
+    merged=(image[:,:,0]<<16)|(image[:,:,1]<<8)|image[:,:,2]
 
-## header creation
-    bytecount=48    
-    bitstring=[]
-
-    bitstring.append(0x53)
-    bitstring.append(0x70)
-    bitstring.append(0x6c)
-    bitstring.append(0x64)
-    
-    width=convlen(1920,16)
-    width=bitstobytes(width)
-    for i in range(len(width)):
-        bitstring.append(width[i])
-
-    height=convlen(1080,16)
-    height=bitstobytes(height)
-    for i in range(len(height)):
-        bitstring.append(height[i])
-
-
-    total=convlen(0,32)
-    total=bitstobytes(total)
-    for i in range(len(total)):
-        bitstring.append(total[i])        
-
-    for i in range(8):
-        bitstring.append(0xff)
-
-    for i in range(4):    ## black curtain
-        bitstring.append(0x00)
-
-    bitstring.append(0x00)
-
-    bitstring.append(0x02) ## enhanced rle
-
-    bitstring.append(0x01)
-
-    for i in range(21):
-        bitstring.append(0x00)
-
-
-
-    n=0
-    i=0
-    j=0
-
-    while i <1080:
-        while j <1920:
-            if i>0 and numpy.all(image[i,j,:]==image[i-1,j,:]):
-                while j<1920 and numpy.all(image[i,j,:]==image[i-1,j,:]):
-                    n=n+1
-                    j=j+1
-
-                bitstring.append(0x00)
-                bitstring.append(0x01)
-                bytecount+=2
-                
-                if n>=128:
-                    byte1=(n & 0x7f)|0x80
-                    byte2=(n >> 7)
-                    bitstring.append(byte1)
-                    bitstring.append(byte2)
-                    bytecount+=2
-                    
-                else:
-                    bitstring.append(n)
-                    bytecount+=1
-                n=0
-
-            
-            else:
-                if j<1919 and numpy.all(image[i,j,:]==image[i,j+1,:]):
-                    n=n+1
-                    while j<1919 and numpy.all(image[i,j,:]==image[i,j+1,:]):
-                        n=n+1
-                        j=j+1
-                    if n>=128:
-                        byte1=(n & 0x7f)|0x80
-                        byte2=(n >> 7)
-                        bitstring.append(byte1)
-                        bitstring.append(byte2)
-                        bytecount+=2
-                        
-                    else:
-                        bitstring.append(n)
-                        bytecount+=1
-
-                    bitstring.append(image[i,j-1,0])
-                    bitstring.append(image[i,j-1,1])
-                    bitstring.append(image[i,j-1,2])
-                    bytecount+=3
-                    
-                    j=j+1
-                    n=0
-
-                else:
-                    if j>1917 or numpy.all(image[i,j+1,:]==image[i,j+2,:]) or numpy.all(image[i,j+1,:]==image[i-1,j+1,:]):
-                        bitstring.append(0x01)
-                        bytecount+=1
-                        bitstring.append(image[i,j,0])
-                        bitstring.append(image[i,j,1])
-                        bitstring.append(image[i,j,2])
-                        bytecount+=3
-                        
-                        j=j+1
-                        n=0
-
-                    else:
-                        bitstring.append(0x00)
-                        bytecount+=1
-
-                        toappend=[]
-
-                        
-                        while numpy.any(image[i,j,:]!=image[i,j+1,:]) and numpy.any(image[i,j,:]!=image[i-1,j,:]) and j<1919:
-                            n=n+1
-                            toappend.append(image[i,j,0])
-                            toappend.append(image[i,j,1])
-                            toappend.append(image[i,j,2])
-                            j=j+1
-
-                        if n>=128:
-                            byte1=(n & 0x7f)|0x80
-                            byte2=(n >> 7)
-                            bitstring.append(byte1)
-                            bitstring.append(byte2)
-                            bytecount+=2
-                                
-                        else:
-                            bitstring.append(n)
-                            bytecount+=1
-
-                        for k in toappend:
-                            bitstring.append(k)
-                            bytecount+=1
-                        n=0
-        j=0
-        i=i+1
-        bitstring.append(0x00)
-        bitstring.append(0x00)
-        bytecount+=2
-    bitstring.append(0x00)
-    bitstring.append(0x01)
-    bitstring.append(0x00)
-    bytecount+=3
-
-
-    while (bytecount)%4!=0:
-        bitstring.append(0x00)
-        bytecount+=1        
-
-    size=bytecount
-
-    total=convlen(size,32)
-    total=bitstobytes(total)
-    for i in range(len(total)):
-        bitstring[i+8]=total[i]    
+    bitstring,bytecount=erle.encode_merged(merged)
 
     return bitstring, bytecount
 
 
 
 ##a dmd controller class
+## all communication goes through the driver core of dlpyc900, by default to the DLPC900 on USB
 
 class dmd():
-    def __init__(self):
-        self.dev=usb.core.find(idVendor=0x0451 ,idProduct=0xc900 )
-
-        self.dev.set_configuration()
+    def __init__(self,transport=None):
+        self.core=core.DriverCore(transport)
 
         self.ans=[]
 
 ## standard usb command function
 
-    def command(self,mode,sequencebyte,com1,com2,data=None):
-        buffer = []
-
-        flagstring=''
-        if mode=='r':
-            flagstring+='1'
-        else:
-            flagstring+='0'        
-        flagstring+='1000000'
-        buffer.append(bitstobytes(flagstring)[0])
-        buffer.append(sequencebyte)
-        temp=bitstobytes(convlen(len(data)+2,16))
-        buffer.append(temp[0])
-        buffer.append(temp[1])
-        buffer.append(com2)
-        buffer.append(com1)
-
-        if len(buffer)+len(data)<65:
-        
-            for i in range(len(data)):
-                buffer.append(data[i])
-
-            for i in range(64-len(buffer)):
-                buffer.append(0x00)
-
-
-            self.dev.write(1, buffer)
-
-        else:
-            for i in range(64-len(buffer)):
-                buffer.append(data[i])
-
-            self.dev.write(1, buffer)
+## with reply=False the reply flag is cleared and no answer is read back, for streaming writes
 
-            buffer = []
+    def command(self,mode,sequencebyte,com1,com2,data=None,reply=True):
+        if data is None:
+            data=[]
 
-            j=0
-            while j<len(data)-58:
-                buffer.append(data[j+58])
-                j=j+1
-                if j%64==0:
-                    self.dev.write(1, buffer)
+        answer=self.core.command(mode,sequencebyte,(com1<<8)|com2,data,reply)
 
-                    buffer = []
+        if mode!='r' and reply:
+            answer=self.core.read_reply(sequencebyte)
+            if answer is None:
+                raise DMDerror('No reply from DMD to command 0x%02X%02X' % (com1,com2))
+        if answer is not None:
+            self.ans=answer
 
-            if j%64!=0:
-
-                while j%64!=0:
-                    buffer.append(0x00)
-                    j=j+1
-
-
-                self.dev.write(1, buffer)                
-                
-
-
-
-
-
-        self.ans=self.dev.read(0x81,64)
-
-## functions for checking error reports in the dlp answer
+## functions for checking error reports in the dlp answer, returns the error code (0 if none)
 
     def checkforerrors(self):
-        self.command('r',0x22,0x01,0x00,[])
-        if self.ans[6]!=0:
-            print (self.ans[6])    
+        return self.core.check()
 
 ## function printing all of the dlp answer
 
@@ -372,60 +162,26 @@ class dmd():
 # The Pattern Display LUT Configuration command controls the execution of patterns stored in the lookup table
 # (LUT). Before executing this command, stop the current pattern sequence.
     def configurelut(self,imgnum,repeatnum):
-        img=convlen(imgnum,11)
-        repeat=convlen(repeatnum,32)
-
-        string=repeat+'00000'+img
+        payload=commands.LUT_CONFIGURATION.pack(entries=imgnum,repeat=repeatnum)
 
-        bytes=bitstobytes(string)
-
-        self.command('w',0x00,0x1a,0x31,bytes)
-        self.checkforerrors()
+        self.command('w',0x00,0x1a,0x31,payload)
+        return self.checkforerrors()
         
 # Pattern display LUT Definition Pp. 59
-    def definepattern(self,index,exposure,bitdepth,color,triggerin,darktime,triggerout,patind,bitpos):
-        payload=[]
-        index=convlen(index,16)
-        index=bitstobytes(index)
-        for i in range(len(index)):
-            payload.append(index[i])
-
-        exposure=convlen(exposure,24)
-        exposure=bitstobytes(exposure)
-        for i in range(len(exposure)):
-            payload.append(exposure[i])
-        optionsbyte=''
-        optionsbyte+='1'
-        bitdepth=convlen(bitdepth-1,3)
-        optionsbyte=bitdepth+optionsbyte
-        optionsbyte=color+optionsbyte
-        if triggerin:
-            optionsbyte='1'+optionsbyte
-        else:
-            optionsbyte='0'+optionsbyte
-
-        payload.append(bitstobytes(optionsbyte)[0])
-
-        darktime=convlen(darktime,24)
-        darktime=bitstobytes(darktime)
-        for i in range(len(darktime)):
-            payload.append(darktime[i])
-
-        triggerout=convlen(triggerout,8)
-        triggerout=bitstobytes(triggerout)
-        payload.append(triggerout[0])
-
-        patind=convlen(patind,11)
-        bitpos=convlen(bitpos,5)
-        lastbits=bitpos+patind
-        lastbits=bitstobytes(lastbits)
-        for i in range(len(lastbits)):
-            payload.append(lastbits[i])
-
-
-
-        self.command('w',0x00,0x1a,0x34,payload)
-        self.checkforerrors()
+## color is a string of 3 bits (blue, green, red), e.g. '111' for white
+## triggerout is byte 9 of the definition: bit 0 disables the trigger 2 output, bit 1 sets extended bit depth
+## with check=False no reply is read and errors are not checked, for sending many definitions before one check
+    def definepattern(self,index,exposure,bitdepth,color,triggerin,darktime,triggerout,patind,bitpos,check=True):
+        if not 0<=triggerout<=3:
+            raise ValueError('triggerout must be 0 to 3, got %d' % triggerout)
+        payload=commands.LUT_DEFINITION.pack(pattern_index=index,exposuretime=exposure,clear_after_exposure=1,
+                                             bitdepth=bitdepth-1,color=int(color,2),wait_for_trigger=triggerin,
+                                             darktime=darktime,disable_pattern_2_trigger_out=triggerout&1,
+                                             extended_bit_depth=triggerout>>1,image_pattern_index=patind,bit_position=bitpos)
+
+        self.command('w',0x00,0x1a,0x34,payload,reply=check)
+        if check:
+            return self.checkforerrors()
         
 
 # Initialize Pattern BMP Load Pp. 61
@@ -433,19 +189,7 @@ class dmd():
 # mode is disabled by command. Follow this command by the Pattern BMP Load command to load the images.
 # Load the images in the reverse order
     def setbmp(self,index,size):
-        payload=[]
-
-        index=convlen(index,5)
-        index='0'*11+index
-        index=bitstobytes(index)
-        for i in range(len(index)):
-            payload.append(index[i]) 
-
-
-        total=convlen(size,32)
-        total=bitstobytes(total)
-        for i in range(len(total)):
-            payload.append(total[i])         
+        payload=commands.BMP_LOAD_INIT.pack(image_index=index,size=size)
         
         self.command('w',0x00,0x1a,0x2a,payload)
         self.checkforerrors()
@@ -457,33 +201,27 @@ class dmd():
 # This command is used for updating the pattern images on-the-fly. This loads the full compressed 24 bit BMP
 # images into the internal memory of the DLPC900. This command is issued after the Init pattern BMP command
 # and multiple times until all the bytes are sent.
-    def bmpload(self,image,size):
-
-        packnum=size//504+1
-
-        counter=0
-
-        for i in range(packnum):
-            if i %100==0:
-                print (i,packnum)
-            payload=[]
-            if i<packnum-1:
-                leng=convlen(504,16)
-                bits=504
-            else:
-                leng=convlen(size%504,16)
-                bits=size%504
-            leng=bitstobytes(leng)
-            for j in range(2):
-                payload.append(leng[j])
-            for j in range(bits):
-                payload.append(image[counter])
-                counter+=1
-            self.command('w',0x11,0x1a,0x2b,payload)
-            self.checkforerrors()
-
-
-    def defsequence(self,images,exp,ti,dt,to,rep):
+## with stream=True the packets are sent without reading a reply, errors are checked once after the
+## last packet and, if checkevery>0, after every checkevery packets
+    def bmpload(self,image,size,stream=False,checkevery=0):
+
+## image is a buffer (bytes, bytearray, uint8 array) or, as the original encoder returned, a list of byte values
+        try:
+            data=memoryview(image)[:size]
+        except TypeError:
+            data=bytes(image[:size])
+        if stream:
+            self.core.send_data(0x1a2b,data,sequence_byte=0x11,check_every=checkevery)
+        else:
+            self.core.send_data(0x1a2b,data,sequence_byte=0x11,reply=True,check_every=1)
+        self.checkforerrors()
+
+
+## the patterns are defined first, then the groups of 24 are merged and encoded on a background thread
+## while the previous group is uploaded, at most queuesize groups ahead
+## with deduplicate=True a frame that repeats an earlier one is uploaded once, its lut entries all point to that upload
+
+    def defsequence(self,images,exp,ti,dt,to,rep,stream=False,checkevery=0,queuesize=2,deduplicate=True):
 
         self.stopsequence()
 
@@ -496,38 +234,45 @@ class dmd():
 
         num=len(arr)
 
-        encodedimages=[]
-        sizes=[]
+## position of every frame among the distinct frames, which are the ones uploaded
 
-        for i in range((num-1)//24+1):
-            print ('merging...')
-            if i<((num-1)//24):
-                imagedata=mergeimages(arr[i*24:(i+1)*24])
-            else:
-                imagedata=mergeimages(arr[i*24:])
-            print ('encoding...')
-            imagedata,size=encode(imagedata)
+        slots={}
+        frames=[]
+        slot=[]
 
-            encodedimages.append(imagedata)
-            sizes.append(size)
+        for j in range(num):
+            key=Sequence.frame_key(arr[j],1) if deduplicate else j
+            if key not in slots:
+                slots[key]=len(frames)
+                frames.append(arr[j])
+            slot.append(slots[key])
 
-            if i<((num-1)//24):
-                for j in range(i*24,(i+1)*24):
-                    self.definepattern(j,exp[j],1,'111',ti[j],dt[j],to[j],i,j-i*24)
-            else:
-                for j in range(i*24,num):
-                    self.definepattern(j,exp[j],1,'111',ti[j],dt[j],to[j],i,j-i*24)
+        for j in range(num):
+            self.definepattern(j,exp[j],1,'111',ti[j],dt[j],to[j],slot[j]//24,slot[j]%24,check=False)
 
-        self.configurelut(num,rep)
+## the definitions are checked once, by the lut configuration that fails when one of them is missing.
+## on an error they are sent again one by one, to report the one that fails
 
-        for i in range((num-1)//24+1):
-        
-            self.setbmp((num-1)//24-i,sizes[(num-1)//24-i])
+        if self.configurelut(num,rep):
+            for j in range(num):
+                if self.definepattern(j,exp[j],1,'111',ti[j],dt[j],to[j],slot[j]//24,slot[j]%24):
+                    break
 
-            print ('uploading...')
-            self.bmpload(encodedimages[(num-1)//24-i],sizes[(num-1)//24-i])
+## the images are loaded in reverse order
 
-        print('complete')
+        def encodegroup(i):
+            print ('merging...')
+            imagedata=mergeimages(frames[i*24:(i+1)*24])
+            print ('encoding...')
+            return encode(imagedata)
 
+        def uploadgroup(i,encoded):
+            imagedata,size=encoded
+            self.setbmp(i,size)
 
+            print ('uploading...')
+            self.bmpload(imagedata,size,stream,checkevery)
+
+        core.pipeline(list(reversed(range((len(frames)-1)//24+1))),encodegroup,uploadgroup,queuesize)
 
+        print('complete')
@@ -1,4 +1,7 @@
 from .dlpyc900 import *
 from .dlp_errors import *
+from .simulator import DLPC900Simulator
+from .asyncdmd import AsyncDMD
+from .sequence import Sequence
 
 AUTHOR = "Piet J.M. Swinkels"
\ No newline at end of file
@@ -0,0 +1,136 @@
+"""
+asyncio counterpart of the dmd class, for acquisition software that controls cameras and stages with asyncio as well.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+from dlpyc900.dlpyc900 import dmd
+from dlpyc900.transport import Transport
+
+
+class AsyncDMD():
+    """
+    DMD controller with coroutines instead of blocking calls.
+
+    All communication goes through a single writer task, which runs the commands one by one on a dedicated thread that owns
+    the transport, so the event loop is never blocked and commands never interleave. Encoding patterns happens on a second
+    thread, so the next pattern can be encoded while the previous one is uploaded.
+
+    The transport itself stays blocking: pyusb has no asynchronous interface, so every USB transfer blocks the transport
+    thread (not the event loop) until it completes or times out, and a command waits for the one before it.
+
+    Every method of `dmd` is available as a coroutine, e.g. `await dlp.get_main_status()`. Use as
+
+        async with AsyncDMD() as dlp:
+            await dlp.set_display_mode('otf')
+
+    Parameters
+    ----------
+    transport : Transport, optional
+        Connection to the controller, by default the DLPC900 on USB.
+    """
+    def __init__(self, transport: Transport = None):
+        self.transport = transport
+        self.dmd = None
+        self._queue = None
+        self._writer = None
+        self._usb_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dmd-transport')
+        self._encode_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dmd-encode')
+
+    async def open(self) -> 'AsyncDMD':
+        """Start the writer task and connect to the DMD. If connecting fails, the writer task and both threads are stopped."""
+        self._queue = asyncio.Queue()
+        self._writer = asyncio.create_task(self._write_loop())
+        try:
+            self.dmd = await self._submit(dmd, self.transport)
+        except BaseException:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+            self._usb_thread.shutdown()
+            self._encode_thread.shutdown()
+            raise
+        return self
+
+    async def close(self):
+        """Finish the queued commands and stop the writer task."""
+        if self._writer is not None:
+            await self._queue.put(None)
+            await self._writer
+            self._writer = None
+        self._usb_thread.shutdown()
+        self._encode_thread.shutdown()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exception_type, exception_value, exception_traceback):
+        await self.close()
+
+    async def _write_loop(self):
+        """The writer task: run queued calls in order on the transport thread."""
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            call, future = item
+            if future.cancelled():
+                continue
+            try:
+                result = await loop.run_in_executor(self._usb_thread, call)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+    def _submit(self, func, *args, **kwargs) -> asyncio.Future:
+        """Queue func(*args, **kwargs) for the writer task, returns a future of its result."""
+        if self._writer is None:
+            raise RuntimeError("AsyncDMD is not open")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((functools.partial(func, *args, **kwargs), future))
+        return future
+
+    def __getattr__(self, name):
+        # every other dmd method as a coroutine running on the writer task
+        if name.startswith('_') or self.dmd is None:
+            raise AttributeError(name)
+        method = getattr(self.dmd, name)
+        if not callable(method):
+            return method
+
+        @functools.wraps(method)
+        async def command(*args, **kwargs):
+            return await self._submit(method, *args, **kwargs)
+        return command
+
+    async def set_display_mode(self, mode: str):
+        """Set the display mode, see dmd.set_display_mode."""
+        return await self._submit(self.dmd.set_display_mode, mode)
+
+    async def setup_pattern_LUT_definition(self, *args, **kwargs):
+        """Add a pattern to the Look Up Table, see dmd.setup_pattern_LUT_definition."""
+        return await self._submit(self.dmd.setup_pattern_LUT_definition, *args, **kwargs)
+
+    async def encode_pattern(self, images: list[numpy.ndarray]) -> tuple[bytes, int]:
+        """Encode images on the encoding thread, see dmd.encode_pattern."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._encode_thread, self.dmd.encode_pattern, images)
+
+    async def load_pattern_on_the_fly(self, images: list[numpy.ndarray], primary: bool = True, image_index: int = 0, chunk_size: int = 504):
+        """
+        Load patterns on-the-fly, see dmd.load_pattern_on_the_fly.
+
+        The images are encoded on the encoding thread while the writer task carries on with earlier commands.
+        """
+        for primary, halves in self.dmd.split_controllers(images, primary):
+            encoded, length = await self.encode_pattern(halves)
+            await self._submit(self.dmd.upload_pattern, encoded, primary, image_index, chunk_size)
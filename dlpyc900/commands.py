@@ -0,0 +1,186 @@
+"""
+Binary layout of the DLPC900 commands, see the [dlpc900 user guide](http://www.ti.com/lit/pdf/dlpu018).
+
+Every command has a `Command` with a precompiled `struct.Struct` of its payload, so payloads are packed straight into bytes.
+Bytes that hold several settings or status flags are described by `BitFields`, which number the bits from the least significant
+bit up, as the user guide does.
+"""
+
+import struct
+import collections
+
+# the first 6 bytes of every command: flag byte, sequence byte, length (payload + 2 command bytes), command, all little endian
+header = struct.Struct('<BBHH')
+
+# bits of the flag byte
+READ = 0x80   # read command
+REPLY = 0x40  # reply wanted
+ERROR = 0x20  # set in the reply when the command failed
+
+
+class BitFields():
+    """
+    Named bit fields packed into one integer.
+
+    Parameters
+    ----------
+    name : str
+        Name of the named tuple returned by `unpack`.
+    *fields : tuple[str, int, int]
+        (name, first bit, number of bits) of every field, bit 0 being the least significant bit.
+    """
+    def __init__(self, name: str, *fields: tuple[str, int, int]):
+        self.names = tuple(field for field, first, bits in fields)
+        self.fields = tuple((field, first, (1 << bits) - 1) for field, first, bits in fields)
+        self.type = collections.namedtuple(name, self.names)
+
+    def pack(self, **values) -> int:
+        """
+        Combine the fields into one integer, fields that are not given are 0 and unknown names are ignored.
+        Raises ValueError if a value does not fit in its field.
+        """
+        packed = 0
+        for field, first, mask in self.fields:
+            value = values.get(field, 0)
+            if value & ~mask:
+                raise ValueError(f"{field} must be 0-{mask}, not {value}")
+            packed |= value << first
+        return packed
+
+    def unpack(self, value: int) -> tuple:
+        """Split an integer into its fields, returns a named tuple."""
+        return self.type._make([(value >> first) & mask for field, first, mask in self.fields])
+
+
+class Command():
+    """
+    Payload layout of a command.
+
+    Parameters
+    ----------
+    number : int
+        The command, as found in the user guide, e.g. 0x1A34.
+    name : str
+        Name of the named tuple returned by `unpack`.
+    layout : str
+        struct format of the payload (little endian), one item per element of `items`.
+    *items : str or BitFields
+        Name of every item of the payload, or the bit fields it holds.
+    """
+    def __init__(self, number: int, name: str, layout: str, *items):
+        self.number = number
+        self.struct = struct.Struct('<' + layout)
+        self.size = self.struct.size
+        self.items = items
+        # item, first bit and mask of every name, plain items are range checked by struct
+        self.fields = {}
+        for i, item in enumerate(items):
+            if isinstance(item, BitFields):
+                for field, first, mask in item.fields:
+                    self.fields[field] = (i, first, mask)
+            else:
+                self.fields[item] = (i, 0, -1)
+        self.type = collections.namedtuple(name, self.fields)
+
+    def pack(self, **values) -> bytes:
+        """Payload with the given values, items or fields that are not given are 0. Raises ValueError if a value does not fit."""
+        words = [0] * len(self.items)
+        for name, value in values.items():
+            try:
+                i, first, mask = self.fields[name]
+            except KeyError:
+                raise TypeError(f"command 0x{self.number:04X} has no field {name}") from None
+            if value & ~mask:
+                raise ValueError(f"{name} must be 0-{mask}, not {value}")
+            words[i] |= value << first
+        try:
+            return self.struct.pack(*words)
+        except struct.error as e:
+            raise ValueError(f"command 0x{self.number:04X}: {e}") from None
+
+    def unpack(self, data) -> tuple:
+        """Values of a payload or reply (which may be longer than the layout), returns a named tuple of all items and fields."""
+        values = []
+        for item, value in zip(self.items, self.struct.unpack_from(data)):
+            if isinstance(item, BitFields):
+                values.extend(item.unpack(value))
+            else:
+                values.append(value)
+        return self.type._make(values)
+
+
+## status commands (section 2.1)
+HARDWARE_STATUS = Command(0x1A0A, 'HardwareStatus', 'B', BitFields('HardwareStatus',
+    ('initialized', 0, 1),
+    ('incompatible', 1, 1),
+    ('reset_controller_error', 2, 1),
+    ('forced_swap_error', 3, 1),
+    ('slave_present', 4, 1),
+    ('sequencer_abort', 6, 1),
+    ('sequencer_error', 7, 1),
+))
+SYSTEM_STATUS = Command(0x1A0B, 'SystemStatus', 'B', BitFields('SystemStatus', ('memory_test_passed', 0, 1)))
+MAIN_STATUS = Command(0x1A0C, 'MainStatus', 'B', BitFields('MainStatus',
+    ('parked', 0, 1),
+    ('sequencer_running', 1, 1),
+    ('video_frozen', 2, 1),
+    ('source_locked', 3, 1),
+    ('port1_syncs_valid', 4, 1),
+    ('port2_syncs_valid', 5, 1),
+))
+COMMUNICATION_STATUS = Command(0x1A49, 'CommunicationStatus', 'B', BitFields('CommunicationStatus',
+    ('controller_error', 0, 1),
+    ('dmd_error', 2, 1),
+))
+# application software, API, software configuration and sequencer configuration revision
+FIRMWARE_VERSION = Command(0x0205, 'FirmwareVersion', 'HBBHBBHBBHBB',
+    'app_patch', 'app_minor', 'app_major',
+    'api_patch', 'api_minor', 'api_major',
+    'config_patch', 'config_minor', 'config_major',
+    'sequencer_patch', 'sequencer_minor', 'sequencer_major',
+)
+
+## parallel interface and input source (section 2.3)
+INPUT_SOURCE = Command(0x1A00, 'InputSource', 'B', BitFields('InputSource', ('source', 0, 3), ('bitdepth', 3, 2)))
+PORT_CLOCK = Command(0x1A03, 'PortClock', 'B', BitFields('PortClock',
+    ('data_port', 0, 2),
+    ('px_clock', 2, 2),
+    ('data_enable', 4, 1),
+    ('vhsync', 5, 1),
+))
+INPUT_SOURCE_CONFIG = Command(0x1A3C, 'InputSourceConfig', 'HHH', 'width', 'height', 'frame_rate')
+TRIGGER_OUT1 = Command(0x1A1D, 'TriggerOut1', 'BHH', 'polarity', 'rising_delay', 'falling_delay')
+TRIGGER_IN1 = Command(0x1A35, 'TriggerIn1', 'I', 'delay')
+MIN_LED_PULSE_WIDTH = Command(0x1A41, 'MinLEDPulseWidth', 'I', 'width')
+
+## pattern display (section 2.4.4.3)
+LUT_CONFIGURATION = Command(0x1A31, 'LUTConfiguration', 'HI', 'entries', 'repeat')
+# the 24 bit exposure and dark times share a 32 bit word with the option byte that follows them, bitdepth is stored as bitdepth - 1
+LUT_DEFINITION = Command(0x1A34, 'LUTDefinition', 'HIIH',
+    'pattern_index',
+    BitFields('Exposure',
+        ('exposuretime', 0, 24),
+        ('clear_after_exposure', 24, 1),
+        ('bitdepth', 25, 3),
+        ('color', 28, 3),
+        ('wait_for_trigger', 31, 1),
+    ),
+    BitFields('Darktime',
+        ('darktime', 0, 24),
+        ('disable_pattern_2_trigger_out', 24, 1),
+        ('extended_bit_depth', 25, 1),
+    ),
+    BitFields('Image', ('image_pattern_index', 0, 11), ('bit_position', 11, 5)),
+)
+
+## pattern on-the-fly (section 2.4.4.4), the slave controller of a dual controller DMD has the same layout
+BMP_LOAD_INIT = Command(0x1A2A, 'BMPLoadInit', 'HI', BitFields('Index', ('image_index', 0, 5)), 'size')
+BMP_LOAD = Command(0x1A2B, 'BMPLoad', 'H', BitFields('Length', ('length', 0, 10)))
+
+commands = {command.number: command for command in (
+    HARDWARE_STATUS, SYSTEM_STATUS, MAIN_STATUS, COMMUNICATION_STATUS, FIRMWARE_VERSION,
+    INPUT_SOURCE, PORT_CLOCK, INPUT_SOURCE_CONFIG, TRIGGER_OUT1, TRIGGER_IN1, MIN_LED_PULSE_WIDTH,
+    LUT_CONFIGURATION, LUT_DEFINITION, BMP_LOAD_INIT, BMP_LOAD,
+)}
+commands[0x1A2C] = BMP_LOAD_INIT
+commands[0x1A2D] = BMP_LOAD
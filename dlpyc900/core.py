@@ -0,0 +1,367 @@
+"""
+Driver core shared by `dlpyc900.dmd` and `PyCrafter6500.dmd`: command framing, chunked writes, reply matching and error lookup,
+see section 1.3 of the [dlpc900 user guide](http://www.ti.com/lit/pdf/dlpu018).
+
+Both drivers only decide what to send, every report to and from the controller passes through `DriverCore`.
+"""
+
+import time
+import queue
+import struct
+import threading
+import usb.core
+from dlpyc900 import commands
+from dlpyc900.transport import Transport, USBTransport
+from dlpyc900.latency import LatencyHistogram
+from dlpyc900.dlp_errors import *
+
+# error codes of the controller, see section 2.1.6
+error_codes = {
+    1  : "Batch file checksum error",
+    2  : "Device failure",
+    3  : "Invalid command number",
+    4  : "Incompatible controller and DMD combination",
+    5  : "Command not allowed in current mode",
+    6  : "Invalid command parameter",
+    7  : "Item referred by the parameter is not present",
+    8  : "Out of resource (RAM or Flash)",
+    9  : "Invalid BMP compression type",
+    10 : "Pattern bit number out of range",
+    11 : "Pattern BMP not present in flash",
+    12 : "Pattern dark time is out of range",
+    13 : "Signal delay parameter is out of range",
+    14 : "Pattern exposure time is out of range",
+    15 : "Pattern number is out of range",
+    16 : "Invalid pattern definition (errors other than 9-15)",
+    17 : "Pattern image memory address is out of range",
+    255: "Internal Error",
+}
+
+def error_message(code: int) -> str:
+    """Description of an error code of the controller."""
+    return error_codes.get(code, f"Undocumented error [{code}]")
+
+# flag byte, sequence byte and data length of a reply
+reply_header = struct.Struct('<BBH')
+
+
+class Reply():
+    """
+    A reply of the DMD, without copying it.
+
+    Also indexes like the tuple (error_flag, flag_byte, sequence_byte, length, data) that older code expects, e.g. reply[-1][0].
+
+    Parameters
+    ----------
+    raw : bytes-like
+        The 64-byte report as read from the transport.
+
+    Attributes
+    ----------
+    error_flag : bool
+        The command failed.
+    flag_byte, sequence_byte, length : int
+        Header fields, length is the number of data bytes.
+    data : memoryview
+        The data bytes, a view on `raw`.
+    """
+    __slots__ = ('raw', 'error_flag', 'flag_byte', 'sequence_byte', 'length', 'data')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.flag_byte, self.sequence_byte, self.length = reply_header.unpack_from(raw)
+        self.error_flag = (self.flag_byte & commands.ERROR) != 0
+        self.data = memoryview(raw).cast('B')[4:4 + self.length]
+
+    def __getitem__(self, index):
+        return (self.error_flag, self.flag_byte, self.sequence_byte, self.length, self.data)[index]
+
+    def __len__(self):
+        return 5
+
+    def __repr__(self):
+        return f"Reply(sequence_byte={self.sequence_byte}, error_flag={self.error_flag}, data={bytes(self.data)!r})"
+
+
+def parse_reply(reply) -> Reply:
+    """
+    Split up the reply of the DMD into its constituant parts, see `Reply`. Returns None if there is no reply.
+    Typically, you only care about the error, sequence_byte and the data.
+    """
+    if reply is None:
+        return None
+    return Reply(reply)
+
+
+def pipeline(items, encode, upload, queue_size: int = 2):
+    """
+    Call `upload(item, encode(item))` for every item in order, encoding on a background thread at most `queue_size` items
+    ahead of the upload, so encoding hides behind the transfer.
+
+    Parameters
+    ----------
+    items : list
+        The items, e.g. groups of images.
+    encode : callable
+        Called with an item on the background thread, e.g. to merge and encode images.
+    upload : callable
+        Called with an item and its encoded result on the calling thread.
+    queue_size : int, optional
+        Number of encoded items that may wait for the upload, by default 2.
+
+    Raises
+    ------
+    Whatever `encode` or `upload` raise, after the background thread has stopped.
+    """
+    encoded = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        # wait for room in the queue, unless the upload has stopped
+        while not stop.is_set():
+            try:
+                encoded.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def encoder():
+        try:
+            for item in items:
+                if not put((False, encode(item))):
+                    return
+        except Exception as e:
+            put((True, e))
+
+    thread = threading.Thread(target=encoder, daemon=True)
+    thread.start()
+    try:
+        for item in items:
+            failed, result = encoded.get()
+            if failed:
+                raise result
+            upload(item, result)
+    finally:
+        stop.set()
+        thread.join()
+
+
+class RetryPolicy():
+    """
+    How long to wait for a reply of the DMD, and how often to try again.
+
+    Parameters
+    ----------
+    timeout : int, optional
+        Time to wait for a reply in ms, by default 500.
+    retries : int, optional
+        Number of times a read command is sent again when no reply came in time, by default 2.
+    backoff : float, optional
+        Pause in seconds before the first retry, by default 0.01.
+    factor : float, optional
+        Every next pause is this many times longer, by default 2.
+    """
+    def __init__(self, timeout: int = 500, retries: int = 2, backoff: float = 0.01, factor: float = 2.0):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.factor = factor
+
+    def delays(self) -> list[float]:
+        """Pauses before each retry, in seconds."""
+        return [self.backoff * self.factor**i for i in range(self.retries)]
+
+
+class DriverCore():
+    """
+    Sends commands to a DLPC900 and reads their replies.
+
+    Parameters
+    ----------
+    transport : Transport, optional
+        Connection to the controller, by default the DLPC900 on USB.
+    """
+    def __init__(self, transport: Transport = None):
+        if transport is None:
+            transport = USBTransport()
+        self.transport = transport
+        # waiting for replies, and the time it took per command
+        self.retry_policy = RetryPolicy()
+        self.latency = LatencyHistogram()
+        # sequence byte of the last read attempt
+        self.sequence = 0
+
+    def next_sequence_byte(self) -> int:
+        """A new sequence byte for a read, different from those of the previous 255 attempts."""
+        self.sequence = (self.sequence + 1) & 0xFF
+        return self.sequence
+
+    @staticmethod
+    def frame(mode: str, sequence_byte: int, command: int, payload=b'', reply: bool = False) -> list[bytes]:
+        """
+        The 64-byte reports of a command, see `command` for the parameters.
+        """
+        if len(payload) + 6 > 512:  # 6 是 Header 和 Command 字节
+            raise DMDerror('Payload exceeds 512-byte buffer limit')
+
+        # Flag Byte: read/write, reply wanted
+        if mode == 'r':
+            flag = commands.READ | commands.REPLY
+        else:
+            flag = commands.REPLY if reply else 0
+
+        # header (flag, sequence byte, payload length + 2 command bytes, command) and payload, in zero padded 64-byte reports
+        packet = commands.header.pack(flag, sequence_byte, len(payload) + 2, command) + bytes(payload)
+        packet += bytes(-len(packet) % 64)
+        return [packet[i:i + 64] for i in range(0, len(packet), 64)]
+
+    def command(self, mode: str, sequence_byte: int, command: int, payload=b'', reply: bool = False):
+        """
+        Send a command, and for a read wait for its reply.
+
+        Writes do not ask the controller for a reply, unless `reply` is set. That reply (with the error flag of the command) is
+        left for the caller to read with `read_reply`, so several writes can be sent before their replies are checked.
+
+        Parameters
+        ----------
+        mode : char
+            'r' for read, 'w' for write
+        sequence_byte : int
+            A byte to identify the command sequence, so you know what reply belongs to what command. Reads ignore it: every
+            attempt of a read gets its own sequence byte from `next_sequence_byte`, so a late reply to an earlier attempt is still
+            accepted, and the replies to the other attempts are skipped as stale by later reads.
+        command : int
+            The command to be sent (16-bit integer), as found in the user guide. For instance '0x0200'
+        payload : bytes-like or list[int], optional
+            Data bytes of the command, empty when reading.
+        reply : bool, optional
+            Ask for a reply to a write as well.
+
+        Returns
+        -------
+        The 64-byte reply of a read, None for a write.
+
+        Raises
+        ------
+        DMDerror
+            If a read gets no reply (after `retry_policy.retries` attempts) or its reply has the error flag set.
+        """
+        start = time.perf_counter()
+        if mode != 'r':
+            for report in self.frame(mode, sequence_byte, command, payload, reply):
+                self.write_report(report)
+            answer = None
+        else:
+            # read reply, reading again is harmless so resend the command (with a new sequence byte) if it does not come
+            attempts = []
+            answer = None
+            for delay in [0.0] + self.retry_policy.delays():
+                if delay:
+                    time.sleep(delay)
+                attempts.append(self.next_sequence_byte())
+                for report in self.frame(mode, attempts[-1], command, payload):
+                    self.write_report(report)
+                answer = self.read_reply(attempts)
+                if answer is not None:
+                    break
+            if answer is None:
+                raise DMDerror(f'No reply from DMD to command 0x{command:04X}')
+            if answer[0] & commands.ERROR:  # 检查 Bit 5
+                raise DMDerror('DMD reply has error flag set!')
+        self.latency.record(command, time.perf_counter() - start)
+        return answer
+
+    def read_reply(self, sequence_byte):
+        """
+        Wait for the reply with the given sequence byte (or any of a list of them), skipping replies to earlier commands.
+        Returns None on timeout.
+        """
+        if isinstance(sequence_byte, int):
+            sequence_byte = (sequence_byte,)
+        deadline = time.perf_counter() + self.retry_policy.timeout / 1000
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return None
+            try:
+                answer = self.transport.read(64, max(1, int(remaining * 1000)))
+            except TimeoutError:
+                return None
+            if answer[1] in sequence_byte:
+                return answer
+
+    def write_report(self, report):
+        """Write a single 64-byte report to the DMD."""
+        try:
+            self.transport.write(report)
+        except usb.USBError:
+            # sometimes timouts occur. If that happens, just wait a very short time and rerun, that will fix the issue in a good 90% of the cases.
+            time.sleep(self.retry_policy.backoff)
+            self.transport.write(report)
+
+    def send_data(self, command: int, data, chunk_size: int = 504, length_prefix: bool = True, sequence_byte: int = 1, reply: bool = False, check_every: int = 0):
+        """
+        Send a large block of data to the DMD as a series of write commands, each carrying `chunk_size` bytes.
+
+        No lists are built: every report is assembled in one reusable 64-byte buffer, directly from a memoryview of the data.
+
+        Parameters
+        ----------
+        command : int
+            The command to be sent (16-bit integer), e.g. 0x1A2B.
+        data : bytes-like
+            The data, e.g. an encoded image.
+        chunk_size : int, optional
+            Number of data bytes per command, at most 506 (504 with `length_prefix`).
+        length_prefix : bool, optional
+            Start the payload of every command with the number of data bytes in it (2 bytes), as the pattern BMP load command expects.
+        sequence_byte : int, optional
+            Sequence byte of all commands.
+        reply : bool, optional
+            Ask for a reply to every command, and wait for it before sending the next one.
+        check_every : int, optional
+            Call `check` (which must then be set) after every `check_every` commands, by default never.
+        """
+        prefix = 2 if length_prefix else 0
+        if not 0 < chunk_size <= 506 - prefix:
+            raise DMDerror('Payload exceeds 512-byte buffer limit')
+        flag = commands.REPLY if reply else 0
+        data = memoryview(data).cast('B')
+        zeros = bytes(64)
+        report = memoryview(bytearray(64))
+        for n, start in enumerate(range(0, len(data), chunk_size), 1):
+            chunk = data[start:start + chunk_size]
+            size = len(chunk)
+            # header: write flag, sequence byte, length (payload + 2 command bytes), command, all little endian
+            length = size + prefix + 2
+            commands.header.pack_into(report, 0, flag, sequence_byte, length, command)
+            if length_prefix:
+                commands.BMP_LOAD.struct.pack_into(report, 6, size)
+            head = 6 + prefix
+            first = min(size, 64 - head)
+            report[head:head + first] = chunk[:first]
+            report[head + first:] = zeros[head + first:]
+            self.write_report(report)
+            # the rest of the command continues in plain 64-byte reports
+            for i in range(first, size, 64):
+                part = chunk[i:i + 64]
+                report[:len(part)] = part
+                report[len(part):] = zeros[len(part):]
+                self.write_report(report)
+            if reply and self.read_reply(sequence_byte) is None:
+                raise DMDerror(f'No reply from DMD to command 0x{command:04X}')
+            if check_every and n % check_every == 0 and start + chunk_size < len(data):
+                self.check()
+
+    def error_code(self) -> int:
+        """Error code of the last executed command, 0 if it succeeded. See `error_codes`."""
+        data = parse_reply(self.command('r', 0x22, 0x0100)).data
+        return data[0] if len(data) else 0
+
+    def check(self) -> int:
+        """Read the error code of the last command and print its description if there is one. Returns the code."""
+        code = self.error_code()
+        if code:
+            print(error_message(code))
+        return code
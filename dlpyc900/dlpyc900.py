@@ -4,15 +4,15 @@ Content of this file is based on Pycrafter 6500 repo, as well as the [dlpc900 us
 Please see the example folder in this repo, which explains a bit more how this works (because I keep forgetting).
 """
 
-import usb.core
-import usb.util
 import time
 import numpy
-import sys
-from dlpyc900.erle import encode
+from dlpyc900.erle import encode, verify
+from dlpyc900.erle_cache import EncodeCache
+from dlpyc900.transport import Transport
+from dlpyc900.latency import LatencyHistogram
+from dlpyc900.core import DriverCore, RetryPolicy, Reply, error_codes, error_message, parse_reply, pipeline
 from dlpyc900.dlp_errors import *
-import array
-import itertools
+from dlpyc900 import commands
 
 def bits_to_bytes(bits: str) -> list[int]:
     """Convert a string of bits to a list of bytes."""
@@ -28,36 +28,70 @@ def bits_to_bools(a : str) -> tuple[int,...]:
     """Convert str of bits ('01101') to tuple of ints (0,1,1,0,1)"""
     return tuple(map(int,a))
 
-def parse_reply( reply : tuple[bool,int,int,int,tuple[int,...]] ):
+# native resolution (width, height) and number of controllers of the DMDs reported by dmd.get_hardware, see the DMD data sheets.
+# A dual controller DMD gets the left half of every image from the master and the right half from the slave (section 2.4.4.4.2)
+dmd_geometry = {
+    "DLP6500" : (1920, 1080, 1),
+    "DLP9000" : (2560, 1600, 2),
+    "DLP670S" : (2716, 1600, 2),
+    "DLP500YX": (2048, 1200, 1),
+    "DLP5500" : (1024, 768, 1),
+}
+
+def pattern_LUT_definition(pattern_index:int = 0, disable_pattern_2_trigger_out:bool = False, extended_bit_depth:bool = False, exposuretime:int = 15000, darktime:int = 0, color:int = 1, bitdepth:int = 8, image_pattern_index:int = 0, bit_position:int = 0, wait_for_trigger:bool = False) -> bytes:
     """
-    Split up the reply of the DMD into its constituant parts:
-    (error_flag, flag_byte, sequence_byte, length, data)
-    Typically, you only care about the error, sequence_byte and the data.
+    Payload of a Pattern Display LUT Definition command (section 2.4.4.3.5), see dmd.setup_pattern_LUT_definition for the parameters.
+    Raises ValueError if a parameter is out of range.
     """
-    if reply == None:
-        return None
-    flag_byte = number_to_bits(reply[0])
-    sequence_byte = reply[1]
-    length = reply[2] | (reply[3] << 8)  # Combine two bytes to form the length
-    data = reply[4:4+length]
-    error_flag = (reply[0] & 0x20) != 0
-    return error_flag, flag_byte, sequence_byte, length, tuple(data)
+    checks = [
+        ('pattern_index', pattern_index, 0, 399),
+        ('exposuretime', exposuretime, 0, 0xFFFFFF),
+        ('darktime', darktime, 0, 0xFFFFFF),
+        ('color', color, 0, 7),
+        ('bitdepth', bitdepth, 1, 8),
+        ('image_pattern_index', image_pattern_index, 0, 0x7FF),
+        ('bit_position', bit_position, 0, 23),
+    ]
+    for name, value, low, high in checks:
+        if not low <= value <= high:
+            raise ValueError(f"{name} must be {low}-{high}, not {value}")
+    return commands.LUT_DEFINITION.pack(
+        pattern_index=pattern_index, exposuretime=exposuretime, clear_after_exposure=0, bitdepth=bitdepth-1, color=color,
+        wait_for_trigger=wait_for_trigger, darktime=darktime, disable_pattern_2_trigger_out=disable_pattern_2_trigger_out,
+        extended_bit_depth=extended_bit_depth, image_pattern_index=image_pattern_index, bit_position=bit_position)
 
 class dmd():
     """
     DMD controller class
+
+    Parameters
+    ----------
+    transport : Transport, optional
+        Connection to the controller, by default the DLPC900 on USB. Pass a `DLPC900Simulator` to run without hardware.
     """
-    def __init__(self):
-        self.dev=usb.core.find(idVendor=0x0451 ,idProduct=0xc900 )
-        self.dev.set_configuration()
+    def __init__(self, transport: Transport = None):
+        # framing, replies, retries and latency bookkeeping
+        self.core = DriverCore(transport)
+        # time in s for the controller to switch display or power mode
+        self.mode_switch_timeout = 2.0
         self.current_mode = "pattern"
         self.display_modes = {'video':0, 'pattern':1, 'video-pattern':2, 'otf':3}
         self.display_modes_inv = {0:'video', 1:'pattern', 2:'video-pattern', 3:'otf'}
+        # debug mode: decode every encoded pattern again before uploading it
+        self.verify_encoding = False
+        # encoded patterns of earlier uploads, set to None to always encode
+        self.encode_cache = EncodeCache()
+        # compression of uploaded patterns: 0 uncompressed, 1 RLE, 2 enhanced RLE or 'auto' for the smallest per image
+        self.compression = 2
+        # encoded length of every image of the last load_patterns_on_the_fly, by (image index, primary)
+        self.uploaded_sizes = {}
         # lets check if connection actually works:
         try:
             self.hardware = self.get_hardware()[0]
         except DMDerror:
             raise DMDerror("Connection to dmd was not succesfull")
+        # width, height and number of controllers, the DLP6500 if the hardware is not known
+        self.width, self.height, self.controllers = dmd_geometry.get(self.hardware, dmd_geometry["DLP6500"])
         
     def __enter__(self):
         return self
@@ -66,11 +100,37 @@ class dmd():
         # Exception handling could be included here
         self.standby()
 
+    @property
+    def transport(self) -> Transport:
+        """Connection to the controller."""
+        return self.core.transport
+
+    @transport.setter
+    def transport(self, transport: Transport):
+        self.core.transport = transport
+
+    @property
+    def retry_policy(self) -> RetryPolicy:
+        """How long to wait for replies, and how often to try again."""
+        return self.core.retry_policy
+
+    @retry_policy.setter
+    def retry_policy(self, retry_policy: RetryPolicy):
+        self.core.retry_policy = retry_policy
+
+    @property
+    def latency(self) -> LatencyHistogram:
+        """Time it took per command."""
+        return self.core.latency
+
 ## direct communication
 
-    def send_command(self, mode: str, sequence_byte: int, command: int, payload: list[int] = None):
+    def send_command(self, mode: str, sequence_byte: int, command: int, payload: list[int] = None, reply: bool = False):
         """
         Send a command to the DMD device.
+
+        Writes do not ask the controller for a reply, unless `reply` is set. That reply (with the error flag of the command) is
+        left for the caller to read with `read_reply`, so several writes can be sent before their replies are checked.
         
         Parameters
         ----------
@@ -78,72 +138,47 @@ class dmd():
             'r' for read, 'w' for write
         sequence_byte : int
             A byte to identify the command sequence, so you know what reply belongs to what command. Choose arbitrary number that fits in 1 byte.
+            Reads number their attempts themselves, see `DriverCore.command`.
         command : int
             The command to be sent (16-bit integer), as found in the user guide. For instance '0x0200'
         payload : int, optional
             List of data bytes associated with the command. Leave empty when reading. Often just a simple number to set a mode, e.g. [1] for option 1. If more complex, you need to craft the byte(s) yourself.
+        reply : bool, optional
+            Ask for a reply to a write as well.
+
+        Returns
+        -------
+        Reply
+            The reply to a read, with its data as a view on the received report. None for a write.
         """
         if payload is None:
-            payload = []
-
-        buffer = []
-
-        # Flag Byte
-        flag_string = '1' if mode == 'r' else '0'
-        flag_string += '1000000'
-        buffer.append(bits_to_bytes(flag_string)[0])
-
-        # Sequence Byte
-        buffer.append(sequence_byte)
+            payload = b''
+        return parse_reply(self.core.command(mode, sequence_byte, command, payload, reply))
 
-        # Length Bytes (payload length + 2 command bytes)
-        temp = bits_to_bytes(number_to_bits(len(payload) + 2, 16))
-        buffer.append(temp[0])
-        buffer.append(temp[1])
+    def read_reply(self, sequence_byte: int):
+        """Wait for the reply with the given sequence byte, skipping replies to earlier commands. Returns None on timeout."""
+        return self.core.read_reply(sequence_byte)
 
-        # Command Bytes (little-endian order)
-        buffer.append(command & 0xFF)         # Lower byte
-        buffer.append((command >> 8) & 0xFF)  # Upper byte
+    def send_data(self, command: int, data, chunk_size: int = 504, length_prefix: bool = True, sequence_byte: int = 1):
+        """
+        Send a large block of data to the DMD as a series of write commands, each carrying `chunk_size` bytes.
 
-        if len(payload) + 6 > 512:  # 6 是 Header 和 Command 字节
-            raise DMDerror('Payload exceeds 512-byte buffer limit')
+        Unlike `send_command`, no lists are built, see `DriverCore.send_data`.
 
-        # Add data to buffer
-        if len(buffer) + len(payload) < 65:
-            buffer.extend(payload)
-            buffer.extend([0x00] * (64 - len(buffer)))
-            try:
-                self.dev.write(1, buffer)
-            except usb.USBError:
-                # sometimes timouts occur. If that happens, just wait a very short time and rerun, that will fix the issue in a good 90% of the cases.
-                time.sleep(0.1)
-                self.dev.write(1, buffer)
-        else:
-            remaining_data = payload
-            buffer.extend(remaining_data[:58])
-            self.dev.write(1, buffer)
-            remaining_data = remaining_data[58:]
-
-            while len(remaining_data) > 0:
-                chunk = remaining_data[:64]
-                remaining_data = remaining_data[64:]
-                if len(chunk) < 64:
-                    chunk.extend([0x00] * (64 - len(chunk)))
-                try:
-                    self.dev.write(1, chunk)
-                except usb.USBError:
-                    # sometimes timouts occur. If that happens, just wait a very short time and rerun, that will fix the issue in a good 90% of the cases.
-                    time.sleep(0.1)
-                    self.dev.write(1, chunk)
-        # read reply if required
-        if mode == 'r':
-            time.sleep(0.1)
-            answer = self.dev.read(0x81, 64)
-            if answer[0] & 0x20:  # 检查 Bit 5
-                raise DMDerror('DMD reply has error flag set!')
-        else:
-            answer = None
-        return parse_reply(answer)
+        Parameters
+        ----------
+        command : int
+            The command to be sent (16-bit integer), e.g. 0x1A2B.
+        data : bytes-like
+            The data, e.g. an encoded image.
+        chunk_size : int, optional
+            Number of data bytes per command, at most 506 (504 with `length_prefix`), see `send_command`.
+        length_prefix : bool, optional
+            Start the payload of every command with the number of data bytes in it (2 bytes), as the pattern BMP load command expects.
+        sequence_byte : int, optional
+            Sequence byte of all commands.
+        """
+        self.core.send_data(command, data, chunk_size, length_prefix, sequence_byte)
 
 ## status commands (section 2.1)
     def get_hardware_status(self) -> tuple[str, int]:
@@ -156,67 +191,35 @@ class dmd():
             First element is report for printing. Second element indicates number of errors found.
         """
         ans = self.send_command('r',10,0x1A0A,[])
-        status = ans[-1][0]
-
-        if not (status & 0x01):
-            statusmessage += "Internal Initialization Error\n"
-            errors += 1
-        if status & 0x02:
-            statusmessage += "Incompatible Controller or DMD\n"
-            errors += 1
-
-        ansbit = number_to_bits(ans[-1][0],8)
+        status = commands.HARDWARE_STATUS.unpack(ans.data)
+        # (counts as error, flag, message when set, message when not set) per status bit
+        messages = [
+            (True, status.initialized == 0, "Internal Initialization Error", "Internal Initialization Successful"),
+            (True, status.incompatible, "Incompatible Controller or DMD, or wrong firmware loaded on system", "System is compatible"),
+            (True, status.reset_controller_error, "DMD Reset Controller Error: Multiple overlapping bias or reset operations are accessing the same DMD block", "DMD Reset Controller has no errors"),
+            (True, status.forced_swap_error, "Forced Swap Error occurred", "No Forced Swap Errors"),
+            (False, status.slave_present, "Secondary Controller Present and Ready", "No Secondary Controller Present"),
+            (True, status.sequencer_abort, "Sequencer has detected an error condition that caused an abort", "Sequencer Abort Status reports no errors"),
+            (True, status.sequencer_error, "Sequencer detected an error", "Sequencer reports no errors"),
+        ]
         statusmessage = ''
         errors = 0
-
-        if ansbit[0] == "0":
-            statusmessage += "Internal Initialization Error\n"
-            errors += 1
-        elif ansbit[0] == "1":
-            statusmessage += "Internal Initialization Successful\n"
-        if ansbit[1] == "0":
-            statusmessage += "System is compatible\n"
-        elif ansbit[1] == "1":
-            statusmessage += "Incompatible Controller or DMD, or wrong firmware loaded on system\n"
-            errors += 1
-        if ansbit[2] == "0":
-            statusmessage += "DMD Reset Controller has no errors\n"
-        elif ansbit[2] == "1":
-            statusmessage += "DMD Reset Controller Error: Multiple overlapping bias or reset operations are accessing the same DMD block\n"
-            errors += 1
-        if ansbit[3] == "0":
-            statusmessage += "No Forced Swap Errors\n"
-        elif ansbit[3] == "1":
-            statusmessage += "Forced Swap Error occurred\n"
-            errors += 1
-        if ansbit[4] == "0":
-            statusmessage += "No Secondary Controller Present\n"
-        elif ansbit[4] == "1":
-            statusmessage += "Secondary Controller Present and Ready\n"
-        if ansbit[6] == "0":
-            statusmessage += "Sequencer Abort Status reports no errors\n"
-        elif ansbit[6] == "1":
-            statusmessage += "Sequencer has detected an error condition that caused an abort\n"
-            errors += 1
-        if ansbit[7] == "0":
-            statusmessage += "Sequencer reports no errors\n"
-        elif ansbit[7] == "1":
-            statusmessage += "Sequencer detected an error\n"
-            errors += 1
+        for error, flag, set_message, clear_message in messages:
+            statusmessage += (set_message if flag else clear_message) + "\n"
+            errors += error and bool(flag)
         return statusmessage, errors
     
     def check_communication_status(self):
         """Check communication with DMD. Raise error when communication is not possible."""
         ans = self.send_command('r',10,0x1A49,[])
-        ansbit = number_to_bits(ans[-1][0],8)
-        if not (ansbit[0] == ansbit[2] == 0):
+        status = commands.COMMUNICATION_STATUS.unpack(ans.data)
+        if status.controller_error or status.dmd_error:
             raise DMDerror("Controller cannot communicate with DMD")
     
     def check_system_status(self):
         "Check system for internal memory errors. Raise error if I find one."
         ans = self.send_command('r',10,0x1A0B,[])
-        ansbit = number_to_bits(ans[-1][0],8)
-        if ansbit[0] == 0:
+        if not commands.SYSTEM_STATUS.unpack(ans.data).memory_test_passed:
             raise DMDerror("Internal Memory Test failed")
     
     def get_main_status(self) -> tuple[int,int,int,int,int,int]:
@@ -235,8 +238,7 @@ class dmd():
             5: 0 - port 2 syncs not valid, 1 - port 2 syncs valid
         """
         ans = self.send_command('r',10,0x1A0C,[])
-        ansbit = number_to_bits(ans[-1][0],8)
-        return bits_to_bools(ansbit)[:6] 
+        return tuple(commands.MAIN_STATUS.unpack(ans.data))
  
     def get_hardware(self) -> tuple[str,str]:
         """
@@ -248,8 +250,8 @@ class dmd():
             First element is hardware product code, second element is the 31 byte ASCII firmware tag information 
         """
         ans = self.send_command('r',10,0x0206,[])
-        hw = ans[-1][0]
-        fw = ans[-1][1:]
+        hw = ans.data[0]
+        fw = ans.data[1:]
         hardware_pos = {0x00:"unknown",0x01: "DLP6500", 0x02:"DLP9000", 0x03:"DLP670S", 0x04: "DLP500YX", 0x05: "DLP5500"}
         try:
             hardware = hardware_pos[hw]
@@ -263,37 +265,13 @@ class dmd():
         check for errors in DMD operation, and raise them if there are any.
         """
         ans = self.send_command('r', 0x22, 0x0100, [])
-        if len(ans[-1]) == 0:
+        if len(ans.data) == 0:
             # This happens sometimes, idk why?
             # Just pretend all is okay
             return None
-        if ans[-1][0] == 0:
+        if ans.data[0] == 0:
             return None
-        error_dict = {
-            1  : "Batch file checksum error",
-            2  : "Device failure",
-            3  : "Invalid command number",
-            4  : "Incompatible controller and DMD combination",
-            5  : "Command not allowed in current mode",
-            6  : "Invalid command parameter",
-            7  : "Item referred by the parameter is not present",
-            8  : "Out of resource (RAM or Flash)",
-            9  : "Invalid BMP compression type",
-            10 : "Pattern bit number out of range",
-            11 : "Pattern BMP not present in flash",
-            12 : "Pattern dark time is out of range",
-            13 : "Signal delay parameter is out of range",
-            14 : "Pattern exposure time is out of range",
-            15 : "Pattern number is out of range",
-            16 : "Invalid pattern definition (errors other than 9-15)",
-            17 : "Pattern image memory address is out of range",
-            255: "Internal Error",
-        }
-        try:
-            error_message = error_dict[ans[-1][0]]
-        except KeyError:
-            error_message = f"Undocumented error [{ans[-1][0]}]"
-        print(error_message)
+        print(error_message(ans.data[0]))
 
 ## functions for parallel interface (to lock an external source) (section 2.3)
     def set_port_clock_definition(self, data_port:int, px_clock:int, data_enable:int, vhsync:int):
@@ -313,12 +291,8 @@ class dmd():
         vhsync : int
             0: P1 VSync & P1 HSync, 1: P2 VSync & P2 HSync
         """
-        payload = 0
-        payload |= data_port & 0x03
-        payload |= (px_clock & 0x03) << 2
-        payload |= (data_enable & 0x01) << 4
-        payload |= (vhsync & 0x01) << 5
-        self.send_command('w', 2, 0x1A03, [payload])
+        payload = commands.PORT_CLOCK.pack(data_port=data_port, px_clock=px_clock, data_enable=data_enable, vhsync=vhsync)
+        self.send_command('w', 2, 0x1A03, payload)
 
     def get_port_clock_definition(self) -> tuple[int,int,int,int]:
         """
@@ -329,15 +303,8 @@ class dmd():
         tuple[int,int,int,int]
             data_port, px_clock, data_enable, vhsync. See set_port_clock_definition doc for their definitions.
         """
-        seq_byte = 243
-        answer = self.send_command('r', seq_byte, 0x1A03, [])
-        assert answer[2] == seq_byte, "received answer does not match command issued"
-        data = answer[-1][0]
-        data_port = data & 0x03
-        px_clock = (data >> 2) & 0x03
-        data_enable = (data >> 4) & 0x01
-        vhsync = (data >> 5) & 0x01
-        return data_port, px_clock, data_enable, vhsync
+        answer = self.send_command('r', 243, 0x1A03, [])
+        return tuple(commands.PORT_CLOCK.unpack(answer.data))
 
     def set_input_source(self, source:int=0, bitdepth:int=0):
         """
@@ -353,10 +320,7 @@ class dmd():
         bitdepth : int, optional
             Bit depth for the parallel interface, with: 0 30-bits, 1 24-bits, 2 20-bits, 3 16-bits, by default 0
         """
-        payload = 0
-        payload |= source & 0x07
-        payload |= (bitdepth & 0x03) << 3
-        self.send_command('w', 1, 0x1A00, [payload])
+        self.send_command('w', 1, 0x1A00, commands.INPUT_SOURCE.pack(source=source, bitdepth=bitdepth))
 
     def get_input_source(self) -> tuple[int,int]:
         """
@@ -367,13 +331,8 @@ class dmd():
         tuple[int,int]
             source, bitdepth. See set_input_source doc for their definitions.
         """
-        seq_byte = 112
-        answer = self.send_command('r', seq_byte, 0x1A00, [])
-        assert answer[2] == seq_byte, "received answer does not match command issued"
-        data = answer[-1][0]
-        source = data & 0x07
-        bitdepth = (data >> 3) & 0x03
-        return source, bitdepth
+        answer = self.send_command('r', 112, 0x1A00, [])
+        return tuple(commands.INPUT_SOURCE.unpack(answer.data))
 
     def lock_displayport(self):
         """
@@ -407,7 +366,7 @@ class dmd():
         locked = self.get_main_status()[3]
         if locked:
             port = self.send_command('r',0,0x1A01,[])
-            return port[-1][0]
+            return port.data[0]
         else:
             return 0
 
@@ -430,14 +389,24 @@ class dmd():
         elif mode == 'video-pattern' and self.current_mode != 'video':
             raise ValueError(f"To change to Video Pattern Mode the system must first change to Video Mode with the desired source enabled and sync must be locked before switching to Video Pattern Mode.")
         self.send_command('w',0x00,0x1A1B,[self.display_modes[mode]])
-        time.sleep(0.5) # required for video-projection mode, just as a safety.
-        try:
-            new_display_mode = self.get_display_mode()
-        except IndexError:
-            # random error sometimes, just go again, no idea why...
-            new_display_mode = self.get_display_mode()
-        if new_display_mode != mode:
+        # switching takes a while (especially to video-projection mode), so keep asking until it is done
+        if self._wait_for(self.get_display_mode, mode) != mode:
             raise ConnectionError("Mode activation failed.")
+
+    def _wait_for(self, getter, expected):
+        """Call getter until it returns expected or mode_switch_timeout has passed. Returns the last value."""
+        deadline = time.perf_counter() + self.mode_switch_timeout
+        delay = self.retry_policy.backoff
+        while True:
+            try:
+                value = getter()
+            except IndexError:
+                # random error sometimes (empty reply), just go again, no idea why...
+                value = None
+            if value == expected or time.perf_counter() > deadline:
+                return value
+            time.sleep(delay)
+            delay = min(delay * self.retry_policy.factor, 0.1)
         
     def get_display_mode(self) -> str:
         """
@@ -449,7 +418,7 @@ class dmd():
             mode name: can be 'video', 'pattern', 'video-pattern', 'otf'(=on the fly).
         """
         ans = self.send_command('r', 0x00, 0x1A1B, [])
-        self.current_mode = self.display_modes_inv[ans[-1][0]]
+        self.current_mode = self.display_modes_inv[ans.data[0]]
         return self.current_mode
     
 ### functions for setting Pattern Display (and LUT) (section 2.4.4.3)
@@ -484,9 +453,7 @@ class dmd():
         nr_of_patterns_to_display : int, optional
             _description_, by default 0
         """
-        byte_01 = bits_to_bytes(number_to_bits(nr_of_LUT_entries,10))
-        byte_25 = bits_to_bytes(number_to_bits(nr_of_patterns_to_display,32))
-        payload = byte_01 + byte_25
+        payload = commands.LUT_CONFIGURATION.pack(entries=nr_of_LUT_entries, repeat=nr_of_patterns_to_display)
         self.send_command('w', 1 ,0x1A31, payload)
 
     def setup_pattern_LUT_definition(self, pattern_index:int = 0, disable_pattern_2_trigger_out:bool = False, extended_bit_depth:bool = False, exposuretime:int = 15000, darktime:int = 0, color:int = 1, bitdepth:int = 8, image_pattern_index:int = 0, bit_position:int = 0):
@@ -514,28 +481,7 @@ class dmd():
         bit_position : int, optional
             Bit position in the image pattern (Frame in video pattern mode). Valid range 0-23. Defaults to 0.
         """
-        disable_pattern_2_trigger_out,extended_bit_depth = int(disable_pattern_2_trigger_out),int(extended_bit_depth)
-        clear_after_exposure, wait_for_trigger = 0,0
-        
-        pattern_index_bytes = [(pattern_index & 0xFF), ((pattern_index >> 8) & 0xFF)]
-        exposuretime_bytes = [(exposuretime & 0xFF), ((exposuretime >> 8) & 0xFF), ((exposuretime >> 16) & 0xFF)]
-        
-        byte_5 = 0
-        byte_5 |= clear_after_exposure & 0x01
-        byte_5 |= (bitdepth-1) & 0x07 << 1
-        byte_5 |= (color) & 0x07 << 4
-        byte_5 |= (wait_for_trigger) & 0x01 << 7
-    
-        darktime_bytes = [(darktime & 0xFF), ((darktime >> 8) & 0xFF), ((darktime >> 16) & 0xFF)]
-        
-        byte_9 = 0
-        byte_9 |= disable_pattern_2_trigger_out & 0x01
-        byte_9 |= (extended_bit_depth) & 0x01 << 1
-        
-        image_pattern_index_bytes = [(image_pattern_index & 0xFF), ((image_pattern_index >> 8) & 0xFF)]
-        bit_postion_byte = (bit_position & 0x1F) << 3
-        byte_10_11 = [image_pattern_index_bytes[0], (image_pattern_index_bytes[1] | bit_postion_byte)]
-        payload = pattern_index_bytes + exposuretime_bytes + [byte_5] + darktime_bytes + [byte_9] + byte_10_11
+        payload = pattern_LUT_definition(pattern_index, disable_pattern_2_trigger_out, extended_bit_depth, exposuretime, darktime, color, bitdepth, image_pattern_index, bit_position)
         self.send_command('w', 1, 0x1A34, payload)
 
 ## functions for power management (section 2.3.1.1 & 2.3.1.2)
@@ -544,8 +490,7 @@ class dmd():
         """Set DMD to standby"""
         self.stop_pattern()
         self.send_command('w',0x00,0x0200,[1])
-        time.sleep(0.1)
-        if self.get_current_powermode() != "standby":
+        if self._wait_for(self.get_current_powermode, "standby") != "standby":
             raise DMDerror("Failed to enter standby mode")
 
     def wakeup(self):
@@ -574,8 +519,8 @@ class dmd():
         str
             current power mode.
         """
-        idlestatus = self.send_command('r',0x00,0x0201,[])[-1][0]
-        sleepstatus = self.send_command('r',0x00,0x0200,[])[-1][0]
+        idlestatus = self.send_command('r',0x00,0x0201,[]).data[0]
+        sleepstatus = self.send_command('r',0x00,0x0200,[]).data[0]
         if sleepstatus == 0:
             if idlestatus == 0:
                 return "normal"
@@ -595,7 +540,7 @@ class dmd():
     def get_flip_longaxis(self) -> bool:
         """Check whether image is flipped along the long axis"""
         answer = self.send_command('r',0,0x1008)
-        return answer[-1][0] > 0
+        return answer.data[0] > 0
 
     def set_flip_shortaxis(self,flip:bool):
         """Flip image along the short axis"""
@@ -604,7 +549,7 @@ class dmd():
     def get_flip_shortaxis(self) -> bool:
         """Check whether image is flipped along the short axis"""
         answer = self.send_command('r',0,0x1009)
-        return answer[-1][0] > 0
+        return answer.data[0] > 0
     
     def get_firmware_version(self) -> tuple[tuple[int, int, int], tuple[int, int, int], tuple[int, int, int], tuple[int, int, int]]:
         """
@@ -617,11 +562,11 @@ class dmd():
             Software config (major, minor, patch), Sequencer config (major, minor, patch).
         """
         ans = self.send_command('r', 10, 0x0205, [])
-        data = ans[-1]
-        app = (data[3], data[2], data[0] | (data[1] << 8))
-        api = (data[7], data[6], data[4] | (data[5] << 8))
-        sw_config = (data[11], data[10], data[8] | (data[9] << 8))
-        seq_config = (data[15], data[14], data[12] | (data[13] << 8))
+        version = commands.FIRMWARE_VERSION.unpack(ans.data)
+        app = (version.app_major, version.app_minor, version.app_patch)
+        api = (version.api_major, version.api_minor, version.api_patch)
+        sw_config = (version.config_major, version.config_minor, version.config_patch)
+        seq_config = (version.sequencer_major, version.sequencer_minor, version.sequencer_patch)
         return app, api, sw_config, seq_config    
     
     # Section 2.1.7
@@ -635,7 +580,7 @@ class dmd():
             ASCII error description.
         """
         ans = self.send_command('r', 10, 0x0101, [])
-        return ''.join(chr(i) for i in ans[-1] if i != 0)    
+        return ''.join(chr(i) for i in ans.data if i != 0)    
 
     # Section 2.3.3
     def set_input_source_config(self, width: int, height: int, frame_rate: int):
@@ -651,11 +596,7 @@ class dmd():
         frame_rate : int
             Frame rate (Hz).
         """
-        payload = [
-            width & 0xFF, (width >> 8) & 0xFF,
-            height & 0xFF, (height >> 8) & 0xFF,
-            frame_rate & 0xFF, (frame_rate >> 8) & 0xFF
-        ]
+        payload = commands.INPUT_SOURCE_CONFIG.pack(width=width, height=height, frame_rate=frame_rate)
         self.send_command('w', 1, 0x1A3C, payload)
 
 
@@ -682,11 +623,7 @@ class dmd():
         width : int
             Pulse width in µs.
         """
-        payload = [
-            width & 0xFF, (width >> 8) & 0xFF,
-            (width >> 16) & 0xFF, (width >> 24) & 0xFF
-        ]
-        self.send_command('w', 1, 0x1A41, payload)
+        self.send_command('w', 1, 0x1A41, commands.MIN_LED_PULSE_WIDTH.pack(width=width))
 
 
     def set_trigger_out1(self, polarity: bool, rising_delay: int, falling_delay: int):
@@ -702,11 +639,7 @@ class dmd():
         falling_delay : int
             Falling edge delay in ns.
         """
-        payload = [
-            int(polarity),
-            rising_delay & 0xFF, (rising_delay >> 8) & 0xFF,
-            falling_delay & 0xFF, (falling_delay >> 8) & 0xFF
-        ]
+        payload = commands.TRIGGER_OUT1.pack(polarity=polarity, rising_delay=rising_delay, falling_delay=falling_delay)
         self.send_command('w', 1, 0x1A1D, payload)
 
 
@@ -719,38 +652,136 @@ class dmd():
         delay : int
             Delay in ns.
         """
-        payload = [
-            delay & 0xFF, (delay >> 8) & 0xFF,
-            (delay >> 16) & 0xFF, (delay >> 24) & 0xFF
-        ]
-        self.send_command('w', 1, 0x1A35, payload)
+        self.send_command('w', 1, 0x1A35, commands.TRIGGER_IN1.pack(delay=delay))
 
-    def load_pattern_on_the_fly(self, images: list[numpy.ndarray], primary: bool = True):
+    def load_pattern_on_the_fly(self, images: list[numpy.ndarray], primary: bool = True, image_index: int = 0, chunk_size: int = 504):
         """
-        Load patterns on-the-fly using ERLE compression.
+        Load patterns on-the-fly using ERLE compression, see section 2.4.4.4. This is `encode_pattern` followed by `upload_pattern`.
         
         Parameters
         ----------
         images : list[numpy.ndarray]
-            List of binary images (1080x1920, up to 24).
+            List of binary images (height x width of the DMD, e.g. 1080x1920, up to 24).
         primary : bool
-            True for primary controller, False for secondary (in dual controller systems).
+            True for primary controller, False for secondary (in dual controller systems). Full width images on a dual
+            controller DMD are split and loaded into both.
+        image_index : int
+            Index (0-17) under which the 24-bit image is stored, as referred to in the pattern LUT definition. When loading several, load them in reverse order.
+        chunk_size : int
+            Number of image bytes per pattern BMP load command, at most 504.
         """
-        encoded, length = encode(images)
+        for primary, halves in self.split_controllers(images, primary):
+            encoded, length = self.encode_pattern(halves)
+            self.upload_pattern(encoded, primary, image_index, chunk_size)
+
+    def split_controllers(self, images: list[numpy.ndarray], primary: bool = True) -> list[tuple[bool, list[numpy.ndarray]]]:
+        """
+        The images each controller gets, as (primary, images): on a dual controller DMD the master gets the left and
+        the slave the right half of full width images. Images of half the width go to the controller chosen by primary.
+
+        Raises
+        ------
+        ValueError
+            If the images do not fit the DMD.
+        """
+        shape = numpy.shape(images[0]) if len(images) else (self.height, self.width)
+        if self.controllers == 2 and shape == (self.height, self.width):
+            half = self.width // 2
+            return [(True, [image[:, :half] for image in images]), (False, [image[:, half:] for image in images])]
+        if shape != (self.height, self.width // self.controllers):
+            raise ValueError(f"Images of shape {shape} do not fit the {self.hardware}, which is {self.width}x{self.height}")
+        return [(primary, images)]
+
+    def load_patterns_on_the_fly(self, images: list[numpy.ndarray], primary: bool = True, chunk_size: int = 504, queue_size: int = 2) -> int:
+        """
+        Load a sequence of more than 24 binary images on-the-fly, in groups of 24 stored under image index 0, 1, 2, ...
+
+        The groups are uploaded in reverse order as the controller requires. While one group is uploaded, the next ones are
+        encoded on a background thread, at most `queue_size` encoded groups ahead, so encoding hides behind the transfer.
+        The encoded length of every image is kept in `uploaded_sizes`.
+
+        Parameters
+        ----------
+        images : list[numpy.ndarray]
+            List of binary images (height x width of the DMD, e.g. 1080x1920), at most 18*24.
+        primary : bool
+            True for primary controller, False for secondary (in dual controller systems), see `load_pattern_on_the_fly`.
+        chunk_size : int
+            Number of image bytes per pattern BMP load command, at most 504.
+        queue_size : int
+            Number of encoded groups that may wait for the upload.
+
+        Returns
+        -------
+        int
+            Number of image indices used.
+        """
+        groups = [images[i:i + 24] for i in range(0, len(images), 24)]
+        if len(groups) > 18:
+            raise DMDerror("At most 18 images of 24 patterns can be loaded")
+        uploads = [(index, controller, halves) for index in reversed(range(len(groups))) for controller, halves in self.split_controllers(groups[index], primary)]
+        self.uploaded_sizes = {}
+
+        def upload(item, encoded):
+            index, controller, halves = item
+            self.upload_pattern(encoded, controller, index, chunk_size)
+            self.uploaded_sizes[index, controller] = len(encoded)
+
+        pipeline(uploads, lambda item: self.encode_pattern(item[2])[0], upload, queue_size)
+        return len(groups)
+
+    def encode_pattern(self, images: list[numpy.ndarray]) -> tuple[bytes, int]:
+        """
+        Encode up to 24 binary images for `upload_pattern`.
+
+        The images are compressed as set in `compression`, by default with enhanced RLE.
+        If `verify_encoding` is set, the encoded patterns are decoded again and compared to the images.
+        Images that were encoded before are taken from `encode_cache` instead of being encoded again.
+
+        Returns
+        -------
+        tuple[bytes, int]
+            The encoded image and its length.
+        """
+        if self.encode_cache is not None:
+            encoded, length = self.encode_cache.encode(images, self.compression)
+        else:
+            encoded, length = encode(images, self.compression)
+        if self.verify_encoding:
+            try:
+                verify(encoded, images)
+            except ValueError as e:
+                raise DMDerror(f"ERLE self-check failed: {e}")
+        return encoded, length
+
+    def upload_pattern(self, encoded: bytes, primary: bool = True, image_index: int = 0, chunk_size: int = 504):
+        """
+        Upload an encoded image (see `encode_pattern`) on-the-fly, see `load_pattern_on_the_fly` for the parameters.
+        """
+        length = len(encoded)
         init_cmd = 0x1A2A if primary else 0x1A2C
         load_cmd = 0x1A2B if primary else 0x1A2D
         
-        # 初始化加载
-        self.send_command('w', 1, init_cmd, [
-            length & 0xFF, (length >> 8) & 0xFF,
-            (length >> 16) & 0xFF, (length >> 24) & 0xFF
-        ])
+        # 初始化加载: image index (2 bytes) and number of bytes including the header (4 bytes)
+        self.send_command('w', 1, init_cmd, commands.BMP_LOAD_INIT.pack(image_index=image_index, size=length))
         
-        # 分块发送数据
-        chunk_size = 60  # 留 4 字节给 Header
-        for i in range(0, len(encoded), chunk_size):
-            chunk = list(encoded[i:i + chunk_size])
-            self.send_command('w', 1, load_cmd, chunk)
+        # 分块发送数据, every packet starts with its length
+        self.send_data(load_cmd, encoded, chunk_size=chunk_size)
+
+
+    def lut_batch(self) -> 'LUTBatch':
+        """
+        Collect pattern LUT definitions and send them in one go, see LUTBatch. Use as
+
+            with dlp.lut_batch() as lut:
+                for i in range(24):
+                    lut.add(exposuretime=1000, bitdepth=1, bit_position=i)
+        """
+        return LUTBatch(self)
+
+    def get_error_code(self) -> int:
+        """Error code of the last executed command, 0 if it succeeded. See `error_codes`."""
+        return self.core.error_code()
 
 
     # I²C 透传命令（Section 2.4.4.5
@@ -782,4 +813,92 @@ class dmd():
     #         port & 0x01,
     #         device_addr & 0x7F
     #     ] + data
-    #     self.send_command('w', 1, 0x1A4F, payload)
\ No newline at end of file
+    #     self.send_command('w', 1, 0x1A4F, payload)
+
+class LUTBatch():
+    """
+    Pattern LUT definitions, checked when added and sent back-to-back with a single error check at the end, see `flush`.
+
+    Parameters
+    ----------
+    dlp : dmd
+        The DMD to program.
+    """
+    def __init__(self, dlp: dmd):
+        self.dlp = dlp
+        self.entries = []
+
+    def add(self, pattern_index: int = None, **definition) -> int:
+        """
+        Add a pattern to the batch, with the parameters of dmd.setup_pattern_LUT_definition.
+        Raises ValueError right away if a parameter is out of range.
+
+        Parameters
+        ----------
+        pattern_index : int, optional
+            location in the LUT, by default the next one after the entries added so far.
+
+        Returns
+        -------
+        int
+            pattern index of the entry.
+        """
+        if pattern_index is None:
+            pattern_index = len(self.entries)
+        self.entries.append((pattern_index, pattern_LUT_definition(pattern_index, **definition)))
+        return pattern_index
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        if exception_type is None:
+            self.flush()
+
+    def flush(self, configure: bool = True, nr_of_patterns_to_display: int = 0, nr_of_LUT_entries: int = None):
+        """
+        Send all definitions, and (if configure) the LUT configuration, without waiting for replies, then read the error code
+        once.
+
+        The error code belongs to the last command only. The configuration fails if one of its entries is not defined, so a
+        definition the controller rejected shows up there, unless its pattern index is still defined from an earlier LUT (the
+        parameters are range checked by `add` already). Without configure only the last definition is checked.
+
+        Parameters
+        ----------
+        configure : bool, optional
+            Also send the Pattern Display LUT Configuration, which makes the definitions effective. By default True.
+        nr_of_patterns_to_display : int, optional
+            see dmd.start_pattern_from_LUT, by default 0 (repeat indefinitely).
+        nr_of_LUT_entries : int, optional
+            see dmd.start_pattern_from_LUT, by default up to the highest pattern index in the batch. Give it when the batch
+            only updates some entries of a longer LUT.
+
+        Raises
+        ------
+        DMDerror
+            If the controller reports an error, naming the entry that caused it.
+        """
+        entries, self.entries = self.entries, []
+        if not entries:
+            return
+        for pattern_index, payload in entries:
+            self.dlp.send_command('w', 1, 0x1A34, payload)
+        if nr_of_LUT_entries is None:
+            nr_of_LUT_entries = 1 + max(pattern_index for pattern_index, payload in entries)
+        if configure:
+            payload = commands.LUT_CONFIGURATION.pack(entries=nr_of_LUT_entries, repeat=nr_of_patterns_to_display)
+            self.dlp.send_command('w', 1, 0x1A31, payload)
+        code = self.dlp.get_error_code()
+        if not code:
+            return
+        # send the definitions again one at a time to find the one that fails, else it was the configuration
+        for i, (pattern_index, payload) in enumerate(entries):
+            self.dlp.send_command('w', 1, 0x1A34, payload)
+            entry_code = self.dlp.get_error_code()
+            if entry_code:
+                raise DMDerror(f"LUT entry {i} (pattern index {pattern_index}): {error_message(entry_code)}")
+        raise DMDerror(f"LUT configuration of {nr_of_LUT_entries} entries: {error_message(code)}")
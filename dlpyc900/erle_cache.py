@@ -0,0 +1,162 @@
+'''
+cache of ERLE encoded images, so patterns that are projected again skip merge and encode
+'''
+
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from dlpyc900.erle import encode, ENHANCED_RLE
+
+
+def image_key(images):
+    '''
+    content hash of up to 24 binary images, images that differ only in 0/1 vs 0/255 get the same key
+
+    the shape of every image is hashed as well, the packed bits of 1080x1920 and 1920x1080 images are the same
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(len(images).to_bytes(1, 'little'))
+    for img in images:
+        img = np.asarray(img)
+        digest.update(np.array(img.shape, dtype='<u4').tobytes())
+        digest.update(np.packbits(img != 0))
+    return digest.hexdigest()
+
+
+class EncodeCache():
+    '''
+    content-addressed cache of encoded images, see erle.encode
+
+    encoded images are kept in memory up to max_bytes, least recently used first out, and optionally in directory
+    up to max_disk_bytes, where the least recently used files are deleted first
+
+    the cache can be shared between threads (AsyncDMD encodes on one thread and uploads on another), the memory tier
+    and the counters are locked, images are encoded and files read and written outside the lock
+    '''
+    def __init__(self, max_bytes=256 << 20, directory=None, max_disk_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self.memory_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bytes_hit = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.erle')
+
+    def get(self, key):
+        '''
+        encoded image stored under key, or None
+        '''
+        with self._lock:
+            encoded = self._memory.get(key)
+            if encoded is not None:
+                self._memory.move_to_end(key)
+                return encoded
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                encoded = f.read()
+        except FileNotFoundError:
+            return None
+        # mark as recently used for eviction, unless another process evicted it since
+        try:
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self.disk_hits += 1
+            self._store(key, encoded)
+        return encoded
+
+    def _store(self, key, encoded):
+        '''
+        keep encoded in memory, evicting the least recently used images beyond max_bytes, with the lock held
+        '''
+        if key in self._memory or len(encoded) > self.max_bytes:
+            return
+        self._memory[key] = encoded
+        self.memory_bytes += len(encoded)
+        while self.memory_bytes > self.max_bytes:
+            _, old = self._memory.popitem(last=False)
+            self.memory_bytes -= len(old)
+
+    def put(self, key, encoded):
+        '''
+        store encoded under key in memory and on disk
+        '''
+        encoded = bytes(encoded)
+        with self._lock:
+            self._store(key, encoded)
+        if self.directory is not None and not os.path.exists(self._path(key)):
+            # write to a temporary file first, so no other process reads a partial file
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(encoded)
+            os.replace(tmp, self._path(key))
+            self._evict_disk()
+
+    def _evict_disk(self):
+        '''
+        delete the least recently used files until the directory holds at most max_disk_bytes
+        '''
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.erle'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def encode(self, images, compression=ENHANCED_RLE):
+        '''
+        encode images like erle.encode, reusing the result of an earlier call with the same images and compression
+        '''
+        key = image_key(images)
+        if compression != ENHANCED_RLE:
+            key += f'-{compression}'
+        encoded = self.get(key)
+        if encoded is None:
+            with self._lock:
+                self.misses += 1
+            encoded, length = encode(images, compression)
+            encoded = bytes(encoded)
+            self.put(key, encoded)
+        else:
+            with self._lock:
+                self.hits += 1
+                self.bytes_hit += len(encoded)
+        return encoded, len(encoded)
+
+    def clear(self):
+        '''
+        empty the memory tier, the files on disk are kept
+        '''
+        with self._lock:
+            self._memory.clear()
+            self.memory_bytes = 0
+
+    def stats(self):
+        '''
+        counters of the cache: hits (of which from disk), misses, bytes served from the cache and bytes in memory
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'bytes_hit': self.bytes_hit, 'memory_bytes': self.memory_bytes, 'entries': len(self._memory)}
@@ -0,0 +1,97 @@
+'''
+compiled ERLE row encoder, used by erle.encode when numba is installed
+
+importing this module raises ImportError without numba, erle then falls back to the numpy encoder
+'''
+
+import numpy as np
+import numba
+
+
+@numba.njit(cache=True)
+def _put_length(out, k, n):
+    '''
+    write n with enc128 at out[k], returns the position after it
+    '''
+    if n >= 128:
+        out[k] = (n & 0x7f) | 0x80
+        out[k+1] = n >> 7
+        return k + 2
+    out[k] = n
+    return k + 1
+
+
+@numba.njit(cache=True)
+def _put_pixel(out, k, pixel):
+    '''
+    write pixel as [B, G, R] at out[k], returns the position after it
+    '''
+    out[k] = (pixel >> 16) & 0xff
+    out[k+1] = (pixel >> 8) & 0xff
+    out[k+2] = pixel & 0xff
+    return k + 3
+
+
+@numba.njit(cache=True)
+def _encode_rows(image, out):
+    '''
+    encode all rows of a merged image into out, which must hold height*(4*width+2) bytes, returns the number of bytes
+    '''
+    height, width = image.shape
+    k = 0
+    for i in range(height):
+        row = image[i]
+        j = 0
+        while j < width:
+            # copy n pixels from previous line
+            if i > 0 and row[j] == image[i-1, j]:
+                r = 1
+                while j + r < width and row[j+r] == image[i-1, j+r]:
+                    r += 1
+                j += r
+                out[k] = 0
+                out[k+1] = 1
+                k = _put_length(out, k + 2, r)
+
+            # repeat single pixel n times
+            elif j < width - 1 and row[j] == row[j+1]:
+                r = 2
+                while j + r < width and row[j+r-1] == row[j+r]:
+                    r += 1
+                j += r
+                k = _put_length(out, k, r)
+                k = _put_pixel(out, k, row[j-1])
+
+            # single uncompressed pixel, when the next pixel starts a copy or repeat
+            elif j > width - 3 or (i > 0 and row[j+1] == image[i-1, j+1]) or row[j+1] == row[j+2]:
+                out[k] = 1
+                k = _put_pixel(out, k + 1, row[j])
+                j += 1
+
+            # multiple uncompressed pixels, the last pixel of the row is always left for a single
+            else:
+                j_start = j
+                j += 2
+                while j < width - 1 and not ((i > 0 and row[j] == image[i-1, j]) or row[j] == row[j+1]):
+                    j += 1
+                out[k] = 0
+                k = _put_length(out, k + 1, j - j_start)
+                for m in range(j_start, j):
+                    k = _put_pixel(out, k, row[m])
+
+        # end of line
+        out[k] = 0
+        out[k+1] = 0
+        k += 2
+    return k
+
+
+def encode_rows_jit(image):
+    '''
+    encode all rows of a merged image, byte for byte the same as erle.encode_rows
+    '''
+    image = np.ascontiguousarray(image, dtype=np.uint32)
+    height, width = image.shape
+    # at most 4 bytes per pixel (a single uncompressed pixel) and 2 per end of line, njit does not check bounds
+    out = np.empty(height * (4*width + 2), dtype=np.uint8)
+    return out[:_encode_rows(image, out)]
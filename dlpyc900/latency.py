@@ -0,0 +1,34 @@
+"""
+Bookkeeping of how long commands to the DMD take, see dmd.latency.
+"""
+
+import collections
+
+
+class LatencyHistogram():
+    """
+    Histogram per command of the time between sending a command and receiving its reply (or finishing the write).
+
+    Latencies are counted in buckets that double in size: bucket b holds latencies below 2**b µs (and at least 2**(b-1) µs).
+    """
+    def __init__(self):
+        self.counts = collections.defaultdict(collections.Counter)
+
+    def record(self, command: int, seconds: float):
+        """Count one round trip of `command` that took `seconds`."""
+        self.counts[command][int(seconds * 1e6).bit_length()] += 1
+
+    def histogram(self, command: int) -> dict[int, int]:
+        """Number of round trips of `command` by upper bound of the bucket in µs."""
+        return {1 << bucket: n for bucket, n in sorted(self.counts[command].items())}
+
+    def clear(self):
+        """Forget all recorded latencies."""
+        self.counts.clear()
+
+    def __str__(self):
+        lines = []
+        for command in sorted(self.counts):
+            buckets = ', '.join(f"<{bound} µs: {n}" for bound, n in self.histogram(command).items())
+            lines.append(f"0x{command:04X}: {buckets}")
+        return '\n'.join(lines)
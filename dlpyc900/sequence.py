@@ -0,0 +1,298 @@
+"""
+Pattern sequences: a list of frames with their display settings, compiled into 24-bit images and a pattern LUT.
+See section 2.4.4.3 and 2.4.4.4 of the [dlpc900 user guide](http://www.ti.com/lit/pdf/dlpu018).
+"""
+
+import hashlib
+import numpy
+from dlpyc900.dlpyc900 import dmd
+from dlpyc900.erle import estimate_size
+
+
+class Sequence():
+    """
+    Builder of a pattern on-the-fly sequence.
+
+    Add binary (or N-bit) frames in display order with `add`, then `upload` them. Identical frames share one slot in the
+    controller memory, and the slots are packed tightly into as few 24-bit images as possible. A frame of bit depth N is
+    pattern k of its image: it takes bits N*k to N*k+N-1, which may span two color bytes, and its LUT entry has bit position
+    k. Table 5-3 of the user guide defines a 2-bit pattern at bit position 1, i.e. in bits 2 and 3.
+
+    Example
+    -------
+        seq = Sequence()
+        for phase in stripes:
+            seq.add(phase, exposuretime=1000, darktime=100)
+        seq.upload(dlp)
+    """
+    def __init__(self):
+        self.frames = []
+        # what deduplication saved in the last upload, see `upload`
+        self.report = None
+        # estimated encoded size before and after optimizing the placement, see `optimize_placement`
+        self.placement = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add(self, image: numpy.ndarray, exposuretime: int = 15000, darktime: int = 0, bitdepth: int = 1, color: int = 1, wait_for_trigger: bool = False, disable_pattern_2_trigger_out: bool = False) -> int:
+        """
+        Append a frame to the sequence.
+
+        Parameters
+        ----------
+        image : numpy.ndarray
+            The frame: binary (0/1 or 0/255) if bitdepth is 1, else values 0 to 2**bitdepth-1.
+        exposuretime : int, optional, in µs
+            on-time of the frame, by default 15000 µs
+        darktime : int, optional, in µs
+            off-time after the frame, by default 0 µs
+        bitdepth : int, optional
+            bit depth of the frame (1-8), by default 1
+        color : int, optional
+            LED(s) to use, see dmd.setup_pattern_LUT_definition, by default 1 (red)
+        wait_for_trigger : bool, optional
+            wait for an external trigger before displaying the frame, by default False
+        disable_pattern_2_trigger_out : bool, optional
+            whether to disable trigger 2 output for this frame, by default False
+
+        Returns
+        -------
+        int
+            position of the frame in the sequence.
+        """
+        image = numpy.asarray(image)
+        if not 1 <= bitdepth <= 8:
+            raise ValueError(f"bitdepth must be 1-8, not {bitdepth}")
+        if self.frames and image.shape != self.frames[0][0].shape:
+            raise ValueError(f"All frames must have the same shape, not {image.shape} and {self.frames[0][0].shape}")
+        if bitdepth > 1 and image.max() >> bitdepth:
+            raise ValueError(f"Frame has values beyond {bitdepth} bits")
+        settings = dict(exposuretime=exposuretime, darktime=darktime, color=color, bitdepth=bitdepth,
+                        wait_for_trigger=wait_for_trigger, disable_pattern_2_trigger_out=disable_pattern_2_trigger_out)
+        self.frames.append((image, settings))
+        return len(self.frames) - 1
+
+    @staticmethod
+    def frame_key(image: numpy.ndarray, bitdepth: int) -> bytes:
+        """Content hash of a frame, binary frames that differ only in 0/1 vs 0/255 get the same key."""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(bytes([bitdepth]))
+        if bitdepth == 1:
+            digest.update(numpy.packbits(image != 0))
+        else:
+            digest.update(numpy.ascontiguousarray(image, dtype=numpy.uint8))
+        return digest.digest()
+
+    def compile(self, deduplicate: bool = True, optimize: bool = False) -> tuple[list[list[numpy.ndarray]], list[dict]]:
+        """
+        Place the frames in 24-bit images.
+
+        Parameters
+        ----------
+        deduplicate : bool, optional
+            store identical frames once, by default True.
+        optimize : bool, optional
+            group binary frames with similar structure into the same image, which compresses better, by default False.
+            The estimated encoded size before and after is kept in `placement`, see `optimize_placement`.
+
+        Returns
+        -------
+        tuple[list[list[numpy.ndarray]], list[dict]]
+            The images, each a list of 24 binary planes (see dmd.load_pattern_on_the_fly), and per frame the parameters
+            of its LUT entry (see LUTBatch.add). The bit position counts patterns of the frame's bit depth, not bits.
+        """
+        # distinct frames, in order of first appearance
+        slots = {}
+        frame_slot = []
+        for i, (image, settings) in enumerate(self.frames):
+            key = self.frame_key(image, settings['bitdepth']) if deduplicate else i
+            if key not in slots:
+                slots[key] = (image, settings['bitdepth'])
+            frame_slot.append(key)
+
+        # first fit, deepest frames first: a frame of N bits goes to the first free pattern k (bits N*k to N*k+N-1) of an image
+        free = []  # per image, bits in use
+        placement = {}  # per key, image index and first bit
+        for key in sorted(slots, key=lambda key: -slots[key][1]):
+            bitdepth = slots[key][1]
+            mask = (1 << bitdepth) - 1
+            for image_index, used in enumerate(free):
+                offset = next((offset for offset in range(0, 25 - bitdepth, bitdepth) if not used & (mask << offset)), None)
+                if offset is not None:
+                    break
+            else:
+                image_index, offset = len(free), 0
+                free.append(0)
+            free[image_index] |= mask << offset
+            placement[key] = (image_index, offset)
+        if optimize:
+            placement = self.optimize_placement(slots, placement)
+
+        images = self._images(slots, placement)
+
+        entries = []
+        for key, (image, settings) in zip(frame_slot, self.frames):
+            image_index, offset = placement[key]
+            entries.append(dict(settings, image_pattern_index=image_index, bit_position=offset // settings['bitdepth']))
+        return images, entries
+
+    def _images(self, slots: dict, placement: dict) -> list[list[numpy.ndarray]]:
+        """The planes of the 24-bit images, with the frames in `slots` placed as in `placement`."""
+        shape = self.frames[0][0].shape if self.frames else (1080, 1920)
+        zero = numpy.zeros(shape, dtype=numpy.uint8)
+        images = [[zero] * 24 for _ in range(1 + max((image_index for image_index, offset in placement.values()), default=-1))]
+        for key, (image_index, offset) in placement.items():
+            image, bitdepth = slots[key]
+            if bitdepth == 1:
+                images[image_index][offset] = image
+            else:
+                for bit in range(bitdepth):
+                    images[image_index][offset + bit] = ((image >> bit) & 1).astype(numpy.uint8)
+        # trailing empty planes need not be encoded
+        if images:
+            last = images[-1]
+            while len(last) > 1 and last[-1] is zero:
+                last.pop()
+        return images
+
+    def optimize_placement(self, slots: dict, placement: dict) -> dict:
+        """
+        Reassign the binary frames to the bits they were given, so that frames with similar structure share an image.
+
+        An image compresses well where all 24 bits of neighbouring pixels are equal: a row is copied from the row above
+        only if no frame in the image changes between the two rows, and a run of equal pixels ends wherever any frame
+        changes. The frames are summarized by which rows differ from the row above and at which columns some row changes,
+        and every image is filled greedily with the frames that add the fewest changed rows and columns to it.
+        The bit positions within an image do not matter to its size.
+
+        Parameters
+        ----------
+        slots : dict
+            per key, the frame and its bit depth.
+        placement : dict
+            per key, the image index and first bit.
+
+        Returns
+        -------
+        dict
+            the new placement. The encoded sizes in bytes before and after (see erle.estimate_size) are kept in `placement`.
+        """
+        rows, columns = {}, {}
+        for key, (image, bitdepth) in slots.items():
+            rows[key], columns[key] = _signature(image, bitdepth)
+        keys = [key for key in placement if slots[key][1] == 1]
+        if not keys:
+            return placement
+        n_images = 1 + max(image_index for image_index, offset in placement.values())
+        height, width = len(next(iter(rows.values()))), len(next(iter(columns.values()))) + 1
+
+        def estimate(placement):
+            return sum(estimate_size(image) for image in self._images(slots, placement))
+
+        before = estimate(placement)
+        new = {key: position for key, position in placement.items() if slots[key][1] > 1}
+        free = [[] for _ in range(n_images)]
+        for key in keys:
+            free[placement[key][0]].append(placement[key])
+        row_signatures = numpy.array([rows[key] for key in keys])
+        column_signatures = numpy.array([columns[key] for key in keys])
+        left = numpy.ones(len(keys), dtype=bool)
+        for image_index in range(n_images):
+            group_rows = numpy.zeros(height, dtype=bool)
+            group_columns = numpy.zeros(width - 1, dtype=bool)
+            for key, (index, offset) in new.items():
+                if index == image_index:
+                    group_rows |= rows[key]
+                    group_columns |= columns[key]
+            for position in free[image_index]:
+                candidates = numpy.flatnonzero(left)
+                if not group_rows.any() and not group_columns.any():
+                    # start with the busiest frame, the others are added around it
+                    cost = -(row_signatures[candidates].sum(axis=1) + column_signatures[candidates].sum(axis=1))
+                else:
+                    cost = _estimate((row_signatures[candidates] | group_rows).sum(axis=1), (column_signatures[candidates] | group_columns).sum(axis=1), height)
+                best = candidates[numpy.argmin(cost)]
+                left[best] = False
+                group_rows |= row_signatures[best]
+                group_columns |= column_signatures[best]
+                new[keys[best]] = position
+        after = estimate(new)
+        if after > before:
+            new, after = placement, before
+        self.placement = {'estimated_bytes_before': before, 'estimated_bytes_after': after}
+        return new
+
+    def upload(self, dlp: dmd, nr_of_patterns_to_display: int = 0, start: bool = True, report: bool = True, optimize: bool = False):
+        """
+        Program the sequence into the DMD: switch to pattern on-the-fly mode, send and configure the LUT, load the images
+        (in reverse order) and start the sequence.
+
+        Parameters
+        ----------
+        dlp : dmd
+            The DMD.
+        nr_of_patterns_to_display : int, optional
+            number of patterns to display, by default 0 (repeat indefinitely).
+        start : bool, optional
+            start displaying the sequence, by default True.
+        report : bool, optional
+            work out what deduplication saved, by default True. The result is kept in `report`: the number of frames and
+            unique frames, the images and encoded bytes uploaded, and the images and bytes saved compared to storing every frame.
+        optimize : bool, optional
+            optimize the placement of the frames for size, by default False, see `compile`.
+
+        Returns
+        -------
+        tuple[list[list[numpy.ndarray]], list[dict]]
+            The images and LUT entries, see `compile`.
+        """
+        images, entries = self.compile(optimize=optimize)
+        if len(images) > 18:
+            raise ValueError(f"Sequence needs {len(images)} images, at most 18 fit in the controller")
+        dlp.stop_pattern()
+        if dlp.get_display_mode() != 'otf':
+            dlp.set_display_mode('otf')
+        lut = dlp.lut_batch()
+        for entry in entries:
+            lut.add(**entry)
+        lut.flush(nr_of_patterns_to_display=nr_of_patterns_to_display)
+        # all images but the last have 24 planes, so they fall into the same groups of 24 again
+        dlp.load_patterns_on_the_fly([plane for image in images for plane in image])
+        if report:
+            self.report = self._report(dlp, images, entries)
+        if start:
+            dlp.start_pattern()
+        return images, entries
+
+    def _report(self, dlp: dmd, images: list[list[numpy.ndarray]], entries: list[dict]) -> dict:
+        """Images and bytes uploaded, and saved by deduplication."""
+        # as encoded by the upload, the layout without deduplication is only estimated
+        uploaded = sum(dlp.uploaded_sizes.values())
+        unique = len({(entry['image_pattern_index'], entry['bit_position'], entry['bitdepth']) for entry in entries})
+        if unique == len(entries):
+            # without repeated frames the layout is the same
+            plain = images
+            plain_bytes = uploaded
+        else:
+            plain = self.compile(deduplicate=False)[0]
+            plain_bytes = sum(estimate_size(halves, dlp.compression) for image in plain for primary, halves in dlp.split_controllers(image))
+        return {'frames': len(entries), 'unique_frames': unique, 'images': len(images), 'bytes': uploaded,
+                'images_saved': len(plain) - len(images), 'bytes_saved': plain_bytes - uploaded}
+
+
+def _signature(image: numpy.ndarray, bitdepth: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """Rows that differ from the row above (the first row always does), and columns where any row changes from the column before."""
+    image = numpy.asarray(image)
+    if bitdepth == 1:
+        image = image != 0
+    rows = numpy.ones(image.shape[0], dtype=bool)
+    rows[1:] = numpy.any(image[1:] != image[:-1], axis=1)
+    columns = numpy.any(image[:, 1:] != image[:, :-1], axis=0)
+    return rows, columns
+
+
+def _estimate(changed_rows, changed_columns, height: int):
+    """Rough ERLE size in bytes of an image from its number of changed rows and columns where runs end."""
+    # a run is a count and a pixel, a copied row a copy command, every row ends with an end of line
+    return 48 + changed_rows * (4 * (changed_columns + 1) + 2) + (height - changed_rows) * 6
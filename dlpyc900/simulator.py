@@ -0,0 +1,261 @@
+"""
+Software model of a DLPC900, to exercise and benchmark the dmd class without the EVM attached.
+
+It models the part of the [dlpc900 user guide](http://www.ti.com/lit/pdf/dlpu018) used by this package: power modes, display mode,
+pattern LUT definition and configuration, pattern on-the-fly loading, status reads and error codes.
+"""
+
+import time
+import collections
+from dlpyc900.transport import Transport
+from dlpyc900 import commands
+
+# error codes, see section 2.1.6
+error_descriptions = {
+    3  : "Invalid command number",
+    5  : "Command not allowed in current mode",
+    6  : "Invalid command parameter",
+    7  : "Item referred by the parameter is not present",
+    9  : "Invalid BMP compression type",
+    10 : "Pattern bit number out of range",
+    14 : "Pattern exposure time is out of range",
+    15 : "Pattern number is out of range",
+}
+
+# plain settings, read back as they were written (with their length when never written)
+settings = {
+    0x1A00: 1,  # input source
+    0x1A01: 1,  # source lock (IT6535 power mode)
+    0x1A03: 1,  # port and clock
+    0x1008: 1,  # long axis flip
+    0x1009: 1,  # short axis flip
+    0x1203: 1,  # test pattern
+    0x1A1D: 5,  # trigger out 1
+    0x1A35: 4,  # trigger in 1
+    0x1A3C: 6,  # input source configuration
+    0x1A41: 4,  # minimum LED pulse width
+}
+
+
+class CommandError(Exception):
+    """Command failed with DLPC900 error code `code`."""
+    def __init__(self, code: int):
+        super().__init__(error_descriptions[code])
+        self.code = code
+
+
+class DLPC900Simulator(Transport):
+    """
+    Transport that executes the commands in software instead of sending them to a DLPC900.
+
+    Replies to read commands (and to writes that ask for one) are queued and returned by `read`, at the earliest `reply_delay` seconds
+    after the command was written.
+    Like the controller, a failing command sets the error code (read with 0x0100) and the error flag of its reply.
+
+    Parameters
+    ----------
+    hardware : str, optional
+        DMD to report, 'DLP6500' or 'DLP9000', by default 'DLP6500'.
+    reply_delay : float, optional
+        Time in seconds before a reply is available, by default 0.
+    timeout : int, optional
+        Default read timeout in ms, by default 1000.
+    """
+    hardware_codes = {'DLP6500': 0x01, 'DLP9000': 0x02}
+
+    def __init__(self, hardware: str = 'DLP6500', reply_delay: float = 0.0, timeout: int = 1000):
+        self.hardware = hardware
+        self.reply_delay = reply_delay
+        self.timeout = timeout
+        self.firmware_tag = 'DLPC900 simulator'
+        self.replies = collections.deque()
+        # log of all executed commands: (command, payload)
+        self.commands = []
+        self._packet = bytearray()
+        self._packet_size = 0
+        self.reset()
+
+    def reset(self):
+        """Power-on state of the controller."""
+        self.standby = 0
+        self.idle = 0
+        self.display_mode = 1
+        self.sequencer = 0
+        self.registers = {}
+        # pattern LUT definitions by pattern index, and the LUT configuration (entries, repeat)
+        self.lut = {}
+        self.lut_config = (0, 0)
+        # images loaded on-the-fly by image index into the master and the slave controller, and the image being loaded
+        # per controller (index, size, data)
+        self.images = {}
+        self.slave_images = {}
+        self._loading = {}
+        self.error = 0
+
+## transport
+
+    def write(self, report):
+        report = bytes(report)
+        if not self._packet:
+            # the first report of a command holds its length, the command may continue over more reports
+            self._packet_size = 4 + (report[2] | (report[3] << 8))
+        self._packet += report
+        if len(self._packet) >= self._packet_size:
+            packet = bytes(self._packet[:self._packet_size])
+            self._packet.clear()
+            self.execute(packet)
+
+    def read(self, size: int = 64, timeout: int = None) -> bytes:
+        if timeout is None:
+            timeout = self.timeout
+        wait = timeout / 1000
+        if self.replies:
+            wait = min(wait, self.replies[0][0] - time.perf_counter())
+        if wait > 0:
+            time.sleep(wait)
+        if not self.replies or self.replies[0][0] > time.perf_counter():
+            raise TimeoutError("No reply from DMD")
+        return self.replies.popleft()[1][:size]
+
+## commands
+
+    def execute(self, packet: bytes):
+        """Execute a complete command packet: flag, sequence byte, length, command and payload."""
+        flag, sequence_byte = packet[0], packet[1]
+        command = packet[4] | (packet[5] << 8)
+        payload = packet[6:]
+        self.commands.append((command, payload))
+        read = bool(flag & 0x80)
+        # reads always get a reply, writes only when asked for
+        reply = read or bool(flag & 0x40)
+        data = b''
+        try:
+            if read:
+                data = self.read_command(command)
+            else:
+                self.write_command(command, payload)
+            if command not in (0x0100, 0x0101):
+                self.error = 0
+        except CommandError as e:
+            self.error = e.code
+            flag |= 0x20
+            data = b''
+        if reply:
+            report = bytes((flag, sequence_byte, len(data) & 0xFF, len(data) >> 8)) + bytes(data)
+            self.replies.append((time.perf_counter() + self.reply_delay, report.ljust(64, b'\x00')))
+
+    def write_command(self, command: int, payload: bytes):
+        """Change the state of the controller as a write of `command` would."""
+        value = payload[0] if payload else 0
+        if command == 0x0200:
+            # power mode: 0 normal, 1 standby, 2 reset
+            if value == 2:
+                self.reset()
+            elif value in (0, 1):
+                self.standby = value
+            else:
+                raise CommandError(6)
+        elif command == 0x0201:
+            # idle mode: 1 enable, 3 disable
+            self.idle = int(value == 1)
+        elif command == 0x1A1B:
+            if value > 3:
+                raise CommandError(6)
+            if value == 2 and not self.registers.get(0x1A01, b'\x00')[0]:
+                # video pattern mode needs a locked source
+                raise CommandError(5)
+            self.display_mode = value
+            self.sequencer = 0
+        elif command == 0x1A24:
+            if value > 2:
+                raise CommandError(6)
+            if value == 2 and self.display_mode == 0:
+                raise CommandError(5)
+            self.sequencer = value
+        elif command == 0x1A34:
+            # pattern display LUT definition, section 2.4.4.3.5
+            if len(payload) < commands.LUT_DEFINITION.size:
+                raise CommandError(6)
+            entry = commands.LUT_DEFINITION.unpack(payload)
+            if entry.pattern_index > 399:
+                raise CommandError(15)
+            if entry.bit_position > 23:
+                raise CommandError(10)
+            if entry.exposuretime < 105:
+                # shortest exposure of a binary pattern
+                raise CommandError(14)
+            self.lut[entry.pattern_index] = bytes(payload[:12])
+        elif command == 0x1A31:
+            # pattern display LUT configuration, section 2.4.4.3.3
+            entries, repeat = commands.LUT_CONFIGURATION.unpack(payload)
+            entries &= 0x3FF
+            if not 0 < entries <= 400:
+                raise CommandError(15)
+            if any(index not in self.lut for index in range(entries)):
+                raise CommandError(7)
+            self.lut_config = (entries, repeat)
+        elif command in (0x1A2A, 0x1A2C):
+            # initialize pattern BMP load, section 2.4.4.4.1
+            if self.display_mode != 3:
+                raise CommandError(5)
+            if len(payload) < commands.BMP_LOAD_INIT.size:
+                raise CommandError(6)
+            index, size = commands.BMP_LOAD_INIT.unpack(payload)
+            if index > 17:
+                raise CommandError(6)
+            self._loading[command] = (index, size, bytearray())
+        elif command in (0x1A2B, 0x1A2D):
+            # pattern BMP load, section 2.4.4.4.2
+            init = command - 1
+            if init not in self._loading:
+                raise CommandError(5)
+            index, size, data = self._loading[init]
+            data += payload[2:2 + commands.BMP_LOAD.unpack(payload).length]
+            if len(data) >= size:
+                del self._loading[init]
+                if data[:4] != b'Spld' or data[25] > 2:
+                    raise CommandError(9)
+                (self.images if command == 0x1A2B else self.slave_images)[index] = bytes(data[:size])
+        elif command in settings:
+            self.registers[command] = bytes(payload)
+        else:
+            raise CommandError(3)
+
+    def read_command(self, command: int) -> bytes:
+        """Reply data of a read of `command`."""
+        if command == 0x0200:
+            return bytes([self.standby])
+        if command == 0x0201:
+            return bytes([self.idle])
+        if command == 0x1A1B:
+            return bytes([self.display_mode])
+        if command == 0x1A24:
+            return bytes([self.sequencer])
+        if command == 0x1A0A:
+            # hardware status: internal initialization successful
+            return bytes([0x01])
+        if command == 0x1A0B:
+            # system status: internal memory test passed
+            return bytes([0x01])
+        if command == 0x1A49:
+            # communication status: no errors
+            return bytes([0x00])
+        if command == 0x1A0C:
+            # main status: bit 1 sequencer running, bit 3 source locked
+            locked = bool(self.registers.get(0x1A01, b'\x00')[0])
+            return commands.MAIN_STATUS.pack(sequencer_running=self.sequencer == 2, source_locked=locked)
+        if command == 0x0206:
+            return bytes([self.hardware_codes.get(self.hardware, 0)]) + self.firmware_tag.encode().ljust(31, b'\x00')
+        if command == 0x0205:
+            # application, API, software and sequencer configuration versions: patch (2 bytes), minor, major
+            return bytes([0, 0, 0, 6] * 4)
+        if command == 0x0100:
+            return bytes([self.error])
+        if command == 0x0101:
+            return error_descriptions.get(self.error, '').encode().ljust(32, b'\x00')
+        if command == 0x1A31:
+            entries, repeat = self.lut_config
+            return entries.to_bytes(2, 'little') + repeat.to_bytes(4, 'little')
+        if command in settings:
+            return self.registers.get(command, bytes(settings[command]))
+        raise CommandError(3)
@@ -0,0 +1,63 @@
+"""
+Transports carry the 64-byte HID reports between the dmd class and a DLPC900, see section 1.3 of the [dlpc900 user guide](http://www.ti.com/lit/pdf/dlpu018).
+
+`USBTransport` talks to the EVM over USB, `dlpyc900.simulator.DLPC900Simulator` emulates the controller in software.
+"""
+
+import usb.core
+import usb.util
+from dlpyc900.dlp_errors import *
+
+
+class Transport():
+    """
+    Interface of a transport: write one report, read one report.
+    """
+    def write(self, report):
+        """Write a single 64-byte report to the controller."""
+        raise NotImplementedError
+
+    def read(self, size: int = 64, timeout: int = None) -> bytes:
+        """
+        Read a single report from the controller.
+
+        Parameters
+        ----------
+        size : int, optional
+            Report size in bytes, by default 64.
+        timeout : int, optional
+            Time to wait for a report in ms, by default the transport's own timeout.
+
+        Raises
+        ------
+        TimeoutError
+            If no report arrived in time.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release the connection."""
+        pass
+
+
+class USBTransport(Transport):
+    """
+    Transport over USB with pyusb, to the first device with the given vendor and product id (by default the DLPC900).
+    """
+    def __init__(self, idVendor: int = 0x0451, idProduct: int = 0xc900):
+        self.dev = usb.core.find(idVendor=idVendor, idProduct=idProduct)
+        if self.dev is None:
+            raise DMDerror("No DLPC900 found on USB")
+        self.dev.set_configuration()
+
+    def write(self, report):
+        self.dev.write(1, report)
+
+    def read(self, size: int = 64, timeout: int = None) -> bytes:
+        try:
+            return self.dev.read(0x81, size, timeout)
+        except usb.core.USBTimeoutError:
+            raise TimeoutError("No reply from DMD")
+
+    def close(self):
+        usb.util.dispose_resources(self.dev)
@@ -0,0 +1,26 @@
+import pytest
+from dlpyc900 import commands
+from dlpyc900.dlpyc900 import pattern_LUT_definition
+
+
+def test_bit_fields():
+    fields = commands.BitFields('Example', ('low', 0, 3), ('flag', 3, 1), ('high', 4, 4))
+    packed = fields.pack(low=5, flag=1, high=0xA)
+    assert packed == 0xAD
+    assert fields.unpack(packed) == (5, 1, 0xA)
+    assert fields.unpack(packed).flag == 1
+    with pytest.raises(ValueError):
+        fields.pack(low=8)
+
+
+def test_lut_definition_layout():
+    payload = pattern_LUT_definition(pattern_index=0x123, exposuretime=0x0A0B0C, darktime=0x010203, color=4, bitdepth=8,
+                                     wait_for_trigger=True, disable_pattern_2_trigger_out=True, image_pattern_index=0x456, bit_position=23)
+    # pattern index, exposure time, options, dark time, trigger out 2, image index with the bit position in the top 5 bits
+    assert payload == bytes([0x23, 0x01, 0x0C, 0x0B, 0x0A, 0b11001110, 0x03, 0x02, 0x01, 0x01, 0x56, (23 << 3) | 0x4])
+    entry = commands.LUT_DEFINITION.unpack(payload)
+    assert (entry.pattern_index, entry.bitdepth, entry.color, entry.bit_position) == (0x123, 7, 4, 23)
+    assert commands.LUT_CONFIGURATION.pack(entries=24, repeat=0) == bytes([24, 0, 0, 0, 0, 0])
+    assert commands.BMP_LOAD_INIT.pack(image_index=3, size=0x12345) == bytes([3, 0, 0x45, 0x23, 0x01, 0])
+    with pytest.raises(ValueError):
+        commands.TRIGGER_IN1.pack(delay=-1)
@@ -0,0 +1,259 @@
+import asyncio
+import numpy
+import pytest
+from dlpyc900 import dmd, erle, parse_reply, AsyncDMD, DLPC900Simulator, DMDerror
+
+
+class RecordingSimulator(DLPC900Simulator):
+    """Simulator that keeps every written report."""
+    def __init__(self, **kwargs):
+        self.reports = []
+        super().__init__(**kwargs)
+
+    def write(self, report):
+        self.reports.append(bytes(report))
+        super().write(report)
+
+
+def test_send_data_matches_send_command():
+    blob = numpy.random.default_rng(0).integers(0, 256, 3001, dtype=numpy.uint8).tobytes()
+    for chunk_size in (58, 60, 200, 506):
+        device = dmd(RecordingSimulator())
+        device.transport.reports = []
+        for i in range(0, len(blob), chunk_size):
+            device.send_command('w', 1, 0x1A2B, list(blob[i:i + chunk_size]))
+        expected = device.transport.reports
+        device.transport.reports = []
+        device.send_data(0x1A2B, blob, chunk_size, length_prefix=False)
+        assert device.transport.reports == expected
+
+
+def test_send_data_length_prefix():
+    blob = numpy.random.default_rng(1).integers(0, 256, 1000, dtype=numpy.uint8).tobytes()
+    device = dmd(RecordingSimulator())
+    device.transport.reports = []
+    for i in range(0, len(blob), 504):
+        chunk = blob[i:i + 504]
+        device.send_command('w', 1, 0x1A2B, [len(chunk) & 0xFF, len(chunk) >> 8] + list(chunk))
+    expected = device.transport.reports
+    device.transport.reports = []
+    device.send_data(0x1A2B, blob)
+    assert device.transport.reports == expected
+    # 6 header bytes + 2 length bytes + 504 data bytes fill exactly 8 reports
+    assert len(expected) == 16
+
+
+def test_simulator_status():
+    device = dmd(DLPC900Simulator(hardware='DLP9000'))
+    assert device.hardware == 'DLP9000'
+    assert device.get_display_mode() == 'pattern'
+    assert device.get_current_powermode() == 'normal'
+    device.idle_on()
+    assert device.get_current_powermode() == 'idle'
+    device.idle_off()
+    device.set_flip_longaxis(True)
+    assert device.get_flip_longaxis()
+    assert device.get_input_source() == (0, 0)
+    device.standby()
+    assert device.get_current_powermode() == 'standby'
+
+
+def test_status_bits():
+    simulator = DLPC900Simulator()
+    device = dmd(simulator)
+    message, errors = device.get_hardware_status()
+    assert errors == 0 and "Internal Initialization Successful" in message
+    device.check_communication_status()
+    device.check_system_status()
+    # bit 0 (parked) first, as in the user guide
+    assert device.get_main_status() == (0, 0, 0, 0, 0, 0)
+    device.lock_hdmi()
+    assert device.get_main_status() == (0, 0, 0, 1, 0, 0)
+    device.set_port_clock_definition(2, 1, 1, 0)
+    assert device.get_port_clock_definition() == (2, 1, 1, 0)
+    assert device.get_firmware_version()[0] == (6, 0, 0)
+
+
+def test_simulator_pattern_on_the_fly():
+    simulator = DLPC900Simulator()
+    device = dmd(simulator)
+    images = [numpy.zeros((1080, 1920), dtype=numpy.uint8) for _ in range(3)]
+    images[1][100:200, 300:400] = 1
+    # loading is only allowed in pattern on-the-fly mode
+    device.load_pattern_on_the_fly(images)
+    assert simulator.error == 5 and not simulator.images
+    device.set_display_mode('otf')
+    device.load_pattern_on_the_fly(images, image_index=1)
+    assert simulator.images == {1: bytes(erle.encode(images)[0])}
+    device.setup_pattern_LUT_definition(pattern_index=0, image_pattern_index=1, bit_position=1)
+    device.start_pattern_from_LUT(nr_of_LUT_entries=1)
+    device.start_pattern()
+    assert simulator.lut_config == (1, 0) and 0 in simulator.lut
+    assert simulator.sequencer == 2
+    # too short exposure is refused by the controller
+    device.setup_pattern_LUT_definition(pattern_index=1, exposuretime=50)
+    assert device.get_error_code() == 14
+    assert device.get_error_description() == "Pattern exposure time is out of range"
+    with pytest.raises(DMDerror):
+        device.send_command('r', 1, 0x1234)
+
+
+def test_reply_matching_and_retries():
+    simulator = RecordingSimulator(reply_delay=0.02)
+    device = dmd(simulator)
+    # a stale reply to an earlier command is skipped
+    device.send_command('r', 7, 0x0200)
+    device.transport.reports = []
+    simulator.replies.appendleft((0, bytes([0xC0, 99, 1, 0, 5]).ljust(64, b'\x00')))
+    assert device.send_command('r', 8, 0x1A1B).data[0] == 1
+    # a reply that comes too late is requested again
+    device.retry_policy.timeout = 10
+    assert device.get_display_mode() == 'pattern'
+    assert len(device.transport.reports) > 2
+    device.retry_policy.retries = 0
+    with pytest.raises(DMDerror):
+        device.get_display_mode()
+    assert sum(device.latency.histogram(0x1A1B).values()) == 2
+
+
+def test_retry_leaves_no_stale_reply():
+    simulator = DLPC900Simulator(reply_delay=0.015)
+    device = dmd(simulator)
+    device.idle_on()
+    # the first read is sent again before its reply comes, both replies arrive
+    device.retry_policy.timeout = 10
+    assert device.get_current_powermode() == 'idle'
+    device.idle_off()
+    device.retry_policy.timeout = 500
+    assert device.get_current_powermode() == 'normal'
+    assert device.get_display_mode() == 'pattern'
+
+
+def test_async_dmd():
+    simulator = DLPC900Simulator(reply_delay=0.001)
+    images = [numpy.zeros((1080, 1920), dtype=numpy.uint8) for _ in range(2)]
+    images[0][:, :960] = 1
+
+    async def run():
+        async with AsyncDMD(simulator) as dlp:
+            await dlp.set_display_mode('otf')
+            # uploads, LUT programming and status reads run concurrently, the writer task keeps them in order
+            await asyncio.gather(
+                dlp.load_pattern_on_the_fly(images, image_index=1),
+                dlp.load_pattern_on_the_fly(images[::-1], image_index=0),
+                dlp.setup_pattern_LUT_definition(pattern_index=0, bit_position=1),
+                dlp.get_main_status(),
+            )
+            assert await dlp.get_display_mode() == 'otf'
+            with pytest.raises(DMDerror):
+                await dlp.send_command('r', 1, 0x1234)
+    asyncio.run(run())
+    assert simulator.images == {1: bytes(erle.encode(images)[0]), 0: bytes(erle.encode(images[::-1])[0])}
+    assert 0 in simulator.lut
+
+
+def test_async_dmd_failed_open():
+    class Unplugged(DLPC900Simulator):
+        def write(self, report):
+            raise OSError("No such device")
+
+    async def run():
+        dlp = AsyncDMD(Unplugged())
+        with pytest.raises(OSError):
+            async with dlp:
+                pass
+        return dlp
+    dlp = asyncio.run(run())
+    # the writer task and both threads are stopped
+    assert dlp._writer is None
+    for executor in (dlp._usb_thread, dlp._encode_thread):
+        with pytest.raises(RuntimeError):
+            executor.submit(print)
+
+
+def test_load_patterns_pipeline():
+    simulator = DLPC900Simulator()
+    device = dmd(simulator)
+    device.set_display_mode('otf')
+    rng = numpy.random.default_rng(4)
+    images = list((rng.random((50, 1080, 1920)) < 0.001).astype(numpy.uint8))
+    assert device.load_patterns_on_the_fly(images, queue_size=1) == 3
+    assert simulator.images == {k: bytes(erle.encode(images[24*k:24*k + 24])[0]) for k in range(3)}
+    # loaded in reverse order
+    assert [payload[0] for command, payload in simulator.commands if command == 0x1A2A] == [2, 1, 0]
+    # an encoding error reaches the caller
+    with pytest.raises(ValueError):
+        device.load_patterns_on_the_fly(images[:30] + [numpy.zeros((10, 10), dtype=numpy.uint8)])
+
+
+def test_lut_batch():
+    simulator = DLPC900Simulator()
+    device = dmd(simulator)
+    with device.lut_batch() as lut:
+        for i in range(400):
+            lut.add(exposuretime=1000 + i, bitdepth=1, color=7, image_pattern_index=i // 24, bit_position=i % 24)
+        with pytest.raises(ValueError):
+            lut.add(bit_position=24)
+    assert simulator.lut_config == (400, 0) and len(simulator.lut) == 400
+    # bit depth 1 and white in byte 5, image 16 and bit 15 in bytes 10-11
+    assert simulator.lut[399] == bytes([0x8F, 0x01, 0x77, 0x05, 0x00, 0x70, 0, 0, 0, 0, 16, 15 << 3])
+    # one error code read for the whole batch
+    assert [command for command, payload in simulator.commands].count(0x0100) == 1
+    # the configuration fails on the undefined entry, sending the entries again finds it
+    device = dmd(DLPC900Simulator())
+    lut = device.lut_batch()
+    lut.add(exposuretime=1000)
+    lut.add(exposuretime=50)
+    lut.add(exposuretime=1000)
+    with pytest.raises(DMDerror, match="LUT entry 1 .*exposure time"):
+        lut.flush()
+    # updating entries 10-12 configures the LUT up to entry 12, or as long as asked
+    simulator = DLPC900Simulator()
+    device = dmd(simulator)
+    with device.lut_batch() as lut:
+        for i in range(20):
+            lut.add(exposuretime=1000)
+    for nr_of_LUT_entries, expected in ((None, 13), (20, 20)):
+        lut = device.lut_batch()
+        for i in range(10, 13):
+            assert lut.add(pattern_index=i, exposuretime=2000) == i
+        lut.flush(nr_of_LUT_entries=nr_of_LUT_entries)
+        assert simulator.lut_config == (expected, 0)
+    assert simulator.lut[11][2:5] == (2000).to_bytes(3, 'little')
+    # a gap in a new LUT fails the configuration
+    device = dmd(DLPC900Simulator())
+    lut = device.lut_batch()
+    lut.add(pattern_index=0, exposuretime=1000)
+    lut.add(pattern_index=2, exposuretime=1000)
+    with pytest.raises(DMDerror, match="LUT configuration of 3 entries"):
+        lut.flush()
+
+
+def test_dual_controller():
+    simulator = DLPC900Simulator(hardware='DLP9000')
+    device = dmd(simulator)
+    assert (device.width, device.height, device.controllers) == (2560, 1600, 2)
+    device.set_display_mode('otf')
+    images = [numpy.zeros((1600, 2560), dtype=numpy.uint8) for _ in range(30)]
+    images[0][:, 1000:1500] = 1
+    assert device.load_patterns_on_the_fly(images) == 2
+    # the master gets the left half, the slave the right half
+    assert numpy.array_equal(erle.decode(simulator.images[0]) & 1, images[0][:, :1280])
+    assert numpy.array_equal(erle.decode(simulator.slave_images[0]) & 1, images[0][:, 1280:])
+    assert sorted(simulator.slave_images) == [0, 1]
+    with pytest.raises(ValueError):
+        device.load_pattern_on_the_fly([numpy.zeros((1080, 1920), dtype=numpy.uint8)])
+
+
+def test_reply_view():
+    raw = bytearray([0xC0, 9, 3, 0, 1, 2, 3]).ljust(64, b'\x00')
+    reply = parse_reply(raw)
+    assert (reply.error_flag, reply.flag_byte, reply.sequence_byte, reply.length) == (False, 0xC0, 9, 3)
+    assert bytes(reply.data) == bytes([1, 2, 3]) and reply[-1][0] == 1
+    # the data is a view on the report, not a copy
+    raw[4] = 7
+    assert reply.data[0] == 7
+    assert not hasattr(reply, '__dict__')
+    device = dmd(DLPC900Simulator())
+    answer = device.send_command('r', 3, 0x1A1B)
+    assert answer.sequence_byte == device.core.sequence and answer.data[0] == 1
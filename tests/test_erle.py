@@ -0,0 +1,273 @@
+import sys
+import types
+import importlib.util
+import numpy
+import pytest
+from dlpyc900 import erle
+
+
+def encode_reference(image):
+    """Encode a merged image row by row with encode_row."""
+    encoded = bytearray(0)
+    for i in range(image.shape[0]):
+        same_prev = numpy.zeros(image.shape[1], dtype=bool) if i == 0 else image[i] == image[i-1]
+        encoded += erle.encode_row(image[i], same_prev)
+    return bytes(encoded)
+
+
+def test_encode_rows_matches_encode_row():
+    rng = numpy.random.default_rng(0)
+    images = [
+        numpy.zeros((4, 1920), dtype=numpy.uint32),
+        rng.integers(0, 3, (6, 1920)).astype(numpy.uint32),
+        rng.integers(0, 1 << 24, (3, 1920)).astype(numpy.uint32),
+        numpy.repeat(rng.integers(0, 2, (5, 1920)), 2, axis=1)[:, :1920].astype(numpy.uint32),
+        numpy.repeat(rng.integers(0, 3, (4, 700)), 2, axis=1)[:, :1358].astype(numpy.uint32),
+    ]
+    for image in images:
+        assert erle.encode_rows(image).tobytes() == encode_reference(image)
+
+
+def test_encode_rows_jit_matches_encode_rows():
+    pytest.importorskip('numba')
+    from dlpyc900.erle_jit import encode_rows_jit
+    rng = numpy.random.default_rng(7)
+    images = [
+        numpy.zeros((4, 1920), dtype=numpy.uint32),
+        rng.integers(0, 3, (6, 1920)).astype(numpy.uint32),
+        rng.integers(0, 1 << 24, (3, 1920)).astype(numpy.uint32),
+        numpy.arange(1920, dtype=numpy.uint32).reshape(1, 1920),
+        numpy.repeat(rng.integers(0, 3, (4, 700)), 2, axis=1)[:, :1358].astype(numpy.uint32),
+        erle.merge(list(numpy.repeat(rng.integers(0, 2, (24, 1080, 240), dtype=numpy.uint8), 8, axis=2))),
+    ]
+    for image in images:
+        assert encode_rows_jit(image).tobytes() == erle.encode_rows(image).tobytes()
+
+
+def test_encode_rows_jit_worst_case(monkeypatch):
+    # run the kernel as plain python, so writing past the output buffer raises instead of corrupting memory
+    monkeypatch.setitem(sys.modules, 'numba', types.SimpleNamespace(njit=lambda **options: (lambda f: f)))
+    spec = importlib.util.spec_from_file_location('erle_jit_python', erle.__file__.replace('erle.py', 'erle_jit.py'))
+    erle_jit = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(erle_jit)
+    # single pixels alternating with 1-pixel copies from the previous row, 3.5 bytes per pixel
+    image = numpy.zeros((6, 40), dtype=numpy.uint32)
+    image[0] = numpy.arange(40)
+    for i in range(1, 6):
+        image[i] = image[i-1]
+        image[i, ::2] = 1000 * i + numpy.arange(20)
+    expected = erle.encode_rows(image).tobytes()
+    assert len(expected) > 6 * (3*40 + 8)
+    assert erle_jit.encode_rows_jit(image).tobytes() == expected
+
+
+def test_literal_run_up_to_end_of_row():
+    # the last pixel of a row is never part of an uncompressed run
+    row = numpy.arange(1920, dtype=numpy.uint32).reshape(1, 1920)
+    assert erle.encode_rows(row).tobytes() == encode_reference(row)
+    assert erle.encode_rows(row).tobytes()[-6:] == b'\x01' + erle.bgr(1919) + b'\x00\x00'
+
+
+def test_encode_stripes():
+    images = []
+    for i in range(8):
+        img = numpy.zeros((1080, 1920), dtype=numpy.uint8)
+        img[:, i*100:(i+1)*100] = 1
+        img[i*50:(i+1)*50, :] ^= 1
+        images.append(img)
+    encoded, length = erle.encode(images)
+    assert length == len(encoded) and length % 4 == 0
+    assert encoded[:48] == erle.header_template[:8] + length.to_bytes(4, 'little') + erle.header_template[12:]
+    content = encode_reference(erle.merge(images))
+    assert encoded[48:48+len(content)+3] == content + b'\x00\x01\x00'
+
+
+def test_decode_round_trip():
+    rng = numpy.random.default_rng(1)
+    yy, xx = numpy.mgrid[:1080, :1920]
+    stacks = [
+        [numpy.zeros((1080, 1920), dtype=numpy.uint8)],
+        [((xx >> i) & 1).astype(numpy.uint8) for i in range(8)],
+        [((yy - 540)**2 + (xx - 960)**2 < (60*i)**2).astype(numpy.uint8) for i in range(1, 6)],
+        [(rng.random((1080, 1920)) < 0.01).astype(numpy.uint8) for _ in range(2)],
+        [((xx + yy*i) % 97 < 40).astype(numpy.uint8) for i in range(24)],
+    ]
+    for images in stacks:
+        encoded, length = erle.encode(images)
+        image, planes = erle.decode(encoded, split_images=True)
+        assert numpy.array_equal(image, erle.merge(images))
+        assert numpy.array_equal(planes[:len(images)], numpy.array(images))
+        assert not planes[len(images):].any()
+        erle.verify(encoded, images)
+
+
+def test_verify_detects_corruption():
+    images = [numpy.zeros((1080, 1920), dtype=numpy.uint8)]
+    images[0][500:600, 700:900] = 1
+    encoded, length = erle.encode(images)
+    images[0][550, 800] = 0
+    with pytest.raises(ValueError):
+        erle.verify(encoded, images)
+    with pytest.raises(ValueError):
+        erle.decode(encoded[:-8])
+
+
+def test_encode_many_matches_encode(monkeypatch):
+    # three groups (the last one short) over two worker processes
+    pools = []
+    class Pool(erle.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            pools.append(args)
+            super().__init__(*args, **kwargs)
+    monkeypatch.setattr(erle, 'ProcessPoolExecutor', Pool)
+    rng = numpy.random.default_rng(2)
+    images = (rng.random((60, 270, 480)) < 0.01).astype(numpy.uint8)
+    assert erle.encode_many(images, workers=2) == [erle.encode(images[i:i + 24]) for i in (0, 24, 48)]
+    assert len(pools) == 1 and pools[0][0] == 2
+
+
+def test_estimate_size():
+    rng = numpy.random.default_rng(4)
+    x = numpy.arange(1920)
+    stacks = [
+        [numpy.zeros((1080, 1920), dtype=numpy.uint8)],
+        [numpy.broadcast_to((x // (i + 2)) % 2, (1080, 1920)).astype(numpy.uint8) for i in range(24)],
+        list(rng.integers(0, 2, (7, 1080, 1920), dtype=numpy.uint8)),
+        list(numpy.repeat(rng.integers(0, 2, (24, 1080, 240), dtype=numpy.uint8), 8, axis=2) * 255),
+        # a few changed rows among copies of the row above
+        list(numpy.repeat(rng.integers(0, 2, (24, 135, 1920), dtype=numpy.uint8), 8, axis=1)),
+    ]
+    for images in stacks:
+        for compression in (erle.RLE, erle.ENHANCED_RLE):
+            assert erle.estimate_size(images, compression) == erle.encode(images, compression)[1]
+        # an upper bound without splitting rows into runs
+        length = erle.encode(images)[1]
+        assert length <= erle.estimate_size(images, exact=False) < 1.5 * length
+
+
+def test_compression_types():
+    rng = numpy.random.default_rng(5)
+    dithered = list(rng.integers(0, 2, (24, 1080, 1920), dtype=numpy.uint8))
+    sparse = list((rng.random((5, 1080, 1920)) < 0.01).astype(numpy.uint8))
+    for images in (dithered, sparse):
+        merged = erle.merge(images)
+        for compression in (erle.UNCOMPRESSED, erle.RLE, erle.ENHANCED_RLE, 'auto'):
+            encoded, length = erle.encode(images, compression)
+            assert length == erle.estimate_size(images, compression)
+            assert numpy.array_equal(erle.decode(encoded), merged)
+    # uncompressed pixels beat any run-length encoding of noise
+    assert erle.encode(dithered, 'auto')[0][25] == erle.UNCOMPRESSED
+    assert erle.encode(sparse, 'auto')[0][25] == erle.RLE
+    # RLE runs are at most 255 pixels, a leftover single pixel is a repeat
+    row = numpy.zeros((1, 1920), dtype=numpy.uint32)
+    row[0, :256] = numpy.arange(1, 257)
+    encoded = erle.encode_rows_rle(row).tobytes()
+    assert encoded[:2] == bytes([0, 255])
+    assert encoded[2 + 3*255:2 + 3*255 + 8] == bytes([1, 0, 1, 0, 255, 0, 0, 0])
+
+
+def test_auto_finds_runs_once(monkeypatch):
+    # the runs compared for 'auto' are the ones encoded
+    calls = []
+    for name in ('find_runs', 'rle_stretches'):
+        monkeypatch.setattr(erle, name, lambda image, f=getattr(erle, name), name=name: calls.append(name) or f(image))
+    monkeypatch.setattr(erle, 'encode_rows_jit', None)
+    rng = numpy.random.default_rng(8)
+    rows = list(numpy.repeat(rng.integers(0, 2, (24, 135, 1920), dtype=numpy.uint8), 8, axis=1))
+    sparse = list((rng.random((5, 1080, 1920)) < 0.01).astype(numpy.uint8))
+    for images, compression in ((rows, erle.ENHANCED_RLE), (sparse, erle.RLE)):
+        calls.clear()
+        encoded, length = erle.encode(images, 'auto')
+        assert encoded[25] == compression
+        assert sorted(calls) == ['find_runs', 'rle_stretches']
+        assert (encoded, length) == erle.encode(images, compression)
+
+
+def test_decode_short_segments(monkeypatch):
+    # runs longer than a segment, and walkers that meet the chain late or not at all
+    rng = numpy.random.default_rng(7)
+    images = list(numpy.repeat(rng.integers(0, 2, (24, 60, 40), dtype=numpy.uint8), 4, axis=2))
+    images[0][10:20] = rng.integers(0, 2, (10, 160), dtype=numpy.uint8)
+    follow_runs = erle.follow_runs
+    for segment in (1, 5, 64):
+        monkeypatch.setattr(erle, 'follow_runs', lambda *args: follow_runs(*args, segment=segment))
+        for compression in (erle.RLE, erle.ENHANCED_RLE):
+            encoded, length = erle.encode(images, compression)
+            assert numpy.array_equal(erle.decode(encoded), erle.merge(images))
+            # the end of image cut off
+            with pytest.raises(ValueError):
+                erle.decode(encoded[:erle.content_size(erle.merge(images), compression) + 45])
+
+
+def test_decode_rle_guide_example():
+    # table 2-108 of the user guide: two rows of 13 pixels, with end of line and end of image padding
+    content = bytes.fromhex(
+        '03 040506  05 777777  00 03 040506 070809 0A0B0C  02 789ABC  00 00'
+        '00 00 00 00 00 00 00 00 00 00 00 00'
+        '07 1D1E1F  06 212223')
+    encoded, length = erle.assemble(content, erle.RLE, (2, 13))
+    encoded += bytes(16)
+    rows = [[0x040506] * 3 + [0x777777] * 5 + [0x040506, 0x070809, 0x0A0B0C] + [0x789ABC] * 2,
+            [0x1D1E1F] * 7 + [0x212223] * 6]
+    assert numpy.array_equal(erle.decode(bytes(encoded)), rows)
+    # the same rows encode to the example without the padding
+    assert erle.encode_rows_rle(numpy.array(rows, dtype=numpy.uint32)).tobytes() == content[:25] + content[37:] + bytes(2)
+
+
+def test_other_geometry():
+    # one controller's half of a DLP9000
+    rng = numpy.random.default_rng(6)
+    images = list(numpy.repeat(rng.integers(0, 2, (24, 1600, 160), dtype=numpy.uint8), 8, axis=2))
+    for compression in (erle.RLE, erle.ENHANCED_RLE):
+        encoded, length = erle.encode(images, compression)
+        assert encoded[4:8] == bytes([0x00, 0x05, 0x40, 0x06])
+        assert length == erle.estimate_size(images, compression)
+        assert numpy.array_equal(erle.decode(encoded), erle.merge(images))
+    with pytest.raises(ValueError):
+        erle.encode([numpy.zeros((1600, 1280)), numpy.zeros((1080, 1920))])
+
+
+def test_merge():
+    rng = numpy.random.default_rng(3)
+    images = rng.integers(0, 2, (24, 1080, 1920), dtype=numpy.uint8)
+    expected = numpy.zeros((1080, 1920), dtype=numpy.uint32)
+    for i, img in enumerate(images):
+        expected |= img.astype(numpy.uint32) << i
+    assert numpy.array_equal(erle.merge(images), expected)
+    assert numpy.array_equal(erle.merge(list(images*255)), expected)
+    assert numpy.array_equal(erle.merge(images.astype(bool)[:11]), expected & 0x7ff)
+    packed = numpy.packbits(images, axis=0, bitorder='little')
+    assert numpy.array_equal(erle.merge_packed(packed), expected)
+    # any nonzero value is a 1, whatever the dtype, as in the cache and sequence keys
+    assert numpy.array_equal(erle.merge(list(images*128)), expected)
+    assert numpy.array_equal(erle.merge(list(images.astype(numpy.uint16)*128)), expected)
+
+
+def test_merge_matches_keys():
+    from dlpyc900.erle_cache import EncodeCache, image_key
+    from dlpyc900 import Sequence
+    mask = numpy.zeros((1080, 1920), dtype=numpy.uint8)
+    mask[100:200, 300:700] = 1
+    half, full = [mask * 128], [mask * 255]
+    assert image_key(half) == image_key(full)
+    assert Sequence.frame_key(half[0], 1) == Sequence.frame_key(full[0], 1)
+    # the cache serves the same bytes encode produces for either mask
+    cache = EncodeCache()
+    assert cache.encode(full)[0] == bytes(erle.encode(full)[0])
+    assert cache.encode(half)[0] == bytes(erle.encode(half)[0]) == bytes(erle.encode(full)[0])
+    assert cache.stats()['hits'] == 1
+
+
+def test_incremental_encoder():
+    yy, xx = numpy.mgrid[:1080, :1920]
+    images = [((xx + yy*i) % 97 < 40).astype(numpy.uint8) for i in range(12)]
+    encoder = erle.IncrementalEncoder(images)
+    assert encoder.encode() == erle.encode(images)
+    for index, rows, cols in [(3, slice(500, 520), slice(100, 140)), (11, slice(0, 2), slice(0, 1920)), (0, slice(1079, 1080), slice(7, 8))]:
+        images[index] = images[index].copy()
+        images[index][rows, cols] ^= 1
+        encoder.update(index, images[index])
+        assert encoder.encode() == erle.encode(images)
+    images.append(numpy.ones((1080, 1920), dtype=numpy.uint8))
+    encoder.update(12, images[12])
+    assert encoder.encode() == erle.encode(images)
@@ -0,0 +1,64 @@
+import os
+import numpy
+from dlpyc900 import erle
+from dlpyc900.erle_cache import EncodeCache, image_key
+
+
+def make_images(seed):
+    rng = numpy.random.default_rng(seed)
+    return [(rng.random((1080, 1920)) < 0.001).astype(numpy.uint8) for _ in range(2)]
+
+
+def test_cache_hits_and_keys():
+    images = make_images(0)
+    cache = EncodeCache()
+    encoded, length = cache.encode(images)
+    assert encoded == bytes(erle.encode(images)[0])
+    assert cache.encode([img*255 for img in images]) == (encoded, length)
+    assert image_key(images) != image_key(make_images(1))
+    # the same pixels in another shape pack into the same bits
+    assert image_key([img.reshape(1920, 1080) for img in images]) != image_key(images)
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['bytes_hit'], stats['entries']) == (1, 1, length, 1)
+
+
+def test_cache_eviction(tmp_path):
+    stacks = [make_images(i) for i in range(3)]
+    size = len(erle.encode(stacks[0])[0])
+    cache = EncodeCache(max_bytes=2*size + size//2, directory=str(tmp_path), max_disk_bytes=2*size + size//2)
+    for images in stacks:
+        cache.encode(images)
+    # the least recently used image is gone from memory and from disk
+    assert cache.stats()['entries'] == 2
+    assert len(os.listdir(tmp_path)) == 2
+    cache.clear()
+    cache.encode(stacks[2])
+    assert cache.stats()['disk_hits'] == 1
+    cache.encode(stacks[0])
+    assert cache.stats()['misses'] == 4
+
+
+def test_cache_file_evicted_while_read(tmp_path, monkeypatch):
+    images = make_images(0)
+    EncodeCache(directory=str(tmp_path)).encode(images)
+    cache = EncodeCache(directory=str(tmp_path))
+    # another process deletes the file between reading it and marking it as used
+    def utime(path):
+        os.remove(path)
+        raise FileNotFoundError(path)
+    monkeypatch.setattr(os, 'utime', utime)
+    assert cache.encode(images)[0] == bytes(erle.encode(images)[0])
+    assert cache.stats()['disk_hits'] == 1
+
+
+def test_cache_shared_between_threads():
+    from concurrent.futures import ThreadPoolExecutor
+    stacks = [[numpy.full((4, 8), i & 1 << k, dtype=numpy.uint8) for k in range(3)] for i in range(8)]
+    size = len(erle.encode(stacks[0])[0])
+    cache = EncodeCache(max_bytes=3*size)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(lambda i: cache.encode(stacks[i % 8]), range(2000)))
+    assert all(result == erle.encode(stacks[i % 8]) for i, result in enumerate(results[:8]))
+    stats = cache.stats()
+    assert stats['hits'] + stats['misses'] == 2000
+    assert stats['entries'] <= 3 and stats['memory_bytes'] == stats['entries'] * size
@@ -0,0 +1,168 @@
+import os
+import sys
+import hashlib
+import numpy
+import pytest
+from dlpyc900 import erle, commands, DLPC900Simulator
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PyCrafter6500'))
+import pycrafter6500
+
+
+def frames(seed):
+    """24 binary images on which the original per-pixel PyCrafter encoder runs to completion."""
+    rng = numpy.random.default_rng(seed)
+    x = numpy.arange(1920)
+    images = [numpy.broadcast_to((x // (i + 3)) % 2, (1080, 1920)).astype(numpy.uint8) for i in range(22)]
+    blocks = numpy.repeat(numpy.repeat(rng.integers(0, 2, (135, 240), dtype=numpy.uint8), 8, axis=0), 8, axis=1)
+    noise = numpy.zeros((1080, 1920), dtype=numpy.uint8)
+    noise[100:140, :1800] = rng.integers(0, 2, (40, 1800), dtype=numpy.uint8)
+    images = [numpy.array(img) for img in images] + [blocks ^ noise]
+    # the last row differs from the first everywhere, the last columns are constant
+    band = numpy.zeros((1080, 1920), dtype=numpy.uint8)
+    band[1000:] = 1
+    images.append(band)
+    for img in images:
+        img[:, 1912:] = 0
+    images[-1][1000:, 1912:] = 1
+    return images
+
+
+def digest(data):
+    return hashlib.blake2b(bytes(data), digest_size=16).hexdigest()
+
+
+def test_pycrafter_encode_pinned():
+    # output of the original mergeimages and encode on these images
+    images = frames(0)
+    merged = pycrafter6500.mergeimages(images)
+    assert merged.shape == (1080, 1920, 3) and merged.dtype == numpy.uint8
+    assert digest(merged.tobytes()) == 'ba5b482295733eca2bf759644bf7641c'
+    encoded, size = pycrafter6500.encode(merged)
+    assert size == len(encoded) == 565128
+    assert digest(encoded) == '5ce998da1c62faaf5c237ba55074a551'
+    # the same bytes as dlpyc900
+    assert bytes(encoded) == bytes(erle.encode(images)[0])
+
+
+class RecordingSimulator(DLPC900Simulator):
+    """Simulator that keeps every written report and counts the reads."""
+    def __init__(self, **kwargs):
+        self.writes = []
+        self.reads = 0
+        super().__init__(**kwargs)
+
+    def write(self, report):
+        self.writes.append(list(bytes(report)))
+        super().write(report)
+
+    def read(self, size=64, timeout=None):
+        self.reads += 1
+        return super().read(size, timeout)
+
+
+def upload(size, **kwargs):
+    simulator = RecordingSimulator()
+    simulator.display_mode = 3
+    dmd = pycrafter6500.dmd(simulator)
+    image = bytearray(i % 251 for i in range(size))
+    image[:4] = b'Spld'
+    image[25] = 2
+    dmd.setbmp(0, size)
+    simulator.writes, simulator.reads = [], 0
+    dmd.bmpload(image, size, **kwargs)
+    assert simulator.images == {0: bytes(image)}
+    return simulator
+
+
+def test_bmpload_stream():
+    size = 504 * 9 + 100
+    plain = upload(size)
+    stream = upload(size, stream=True)
+    checked = upload(size, stream=True, checkevery=4)
+    # one read per packet and one per error check, against a single check at the end
+    assert plain.reads == 2 * 10
+    assert stream.reads == 1
+    assert checked.reads == 3
+    # the same data, only the reply flag and the error check commands differ
+    packets = [w for w in plain.writes if w[4:6] == [0x2b, 0x1a]]
+    assert all(w[0] == 0x40 for w in packets)
+    streamed = [w for w in stream.writes if w[4:6] == [0x2b, 0x1a]]
+    assert all(w[0] == 0x00 for w in streamed)
+    def is_check(w):
+        # error code read, with the sequence byte of the read
+        return w[:1] + w[2:] == [0xc0, 2, 0, 0x00, 0x01] + [0] * 58
+    data = [w for w in plain.writes if not is_check(w)]
+    assert is_check(stream.writes[-1])
+    assert len(data) == len(stream.writes) - 1
+    for a, b in zip(data, stream.writes):
+        assert a[1:] == b[1:] and (a[0] == b[0] or (a[0], b[0]) == (0x40, 0x00))
+
+
+def test_bmpload_list():
+    # a list of byte values, as the original encoder returned, loads like the bytes
+    simulator = DLPC900Simulator()
+    simulator.display_mode = 3
+    dmd = pycrafter6500.dmd(simulator)
+    images = [numpy.zeros((1080, 1920), dtype=numpy.uint8)]
+    images[0][500:600, 700:900] = 1
+    encoded, size = erle.encode(images)
+    for image in (list(encoded), encoded):
+        dmd.setbmp(0, size)
+        dmd.bmpload(image, size)
+        assert simulator.images[0] == bytes(encoded)
+
+
+def test_definepattern_triggerout():
+    simulator = DLPC900Simulator()
+    dmd = pycrafter6500.dmd(simulator)
+    dmd.definepattern(0, 1000, 1, '111', 0, 0, 3, 0, 0)
+    entry = commands.LUT_DEFINITION.unpack(simulator.lut[0])
+    assert (entry.disable_pattern_2_trigger_out, entry.extended_bit_depth) == (1, 1)
+    with pytest.raises(ValueError, match='triggerout'):
+        dmd.definepattern(0, 1000, 1, '111', 0, 0, 4, 0, 0)
+
+
+def test_defsequence(capsys):
+    simulator = DLPC900Simulator()
+    simulator.display_mode = 3
+    dmd = pycrafter6500.dmd(simulator)
+    rng = numpy.random.default_rng(1)
+    images = list(numpy.repeat(rng.integers(0, 2, (30, 1080, 240), dtype=numpy.uint8), 8, axis=2))
+    n = len(images)
+    dmd.defsequence(images, [1000] * n, [0] * n, [0] * n, [0] * n, 5)
+    assert simulator.lut_config == (30, 5) and sorted(simulator.lut) == list(range(30))
+    assert numpy.array_equal(erle.decode(simulator.images[1]), erle.merge(images[24:]))
+    # the definitions are checked once, by the lut configuration, before the first image upload
+    sent = [command for command, payload in simulator.commands]
+    assert sent[:sent.index(0x1A2A)].count(0x0100) == 2
+    # encoded on a background thread, loaded in reverse order, encoding errors reach the caller
+    assert [payload[0] for command, payload in simulator.commands if command == 0x1A2A] == [1, 0]
+    with pytest.raises(ValueError):
+        dmd.defsequence(images[:24] + [numpy.zeros((10, 10), dtype=numpy.uint8)] + images[24:], [1000] * 31, [0] * 31, [0] * 31, [0] * 31, 0)
+    # a definition the controller rejects is found by sending them again
+    dmd = pycrafter6500.dmd(DLPC900Simulator())
+    dmd.core.transport.display_mode = 3
+    exposures = [1000] * n
+    exposures[5] = 50
+    capsys.readouterr()
+    dmd.defsequence(images, exposures, [0] * n, [0] * n, [0] * n, 0)
+    assert 'Pattern exposure time is out of range' in capsys.readouterr().out
+
+
+def test_defsequence_repeated_frames():
+    simulator = DLPC900Simulator()
+    simulator.display_mode = 3
+    dmd = pycrafter6500.dmd(simulator)
+    rng = numpy.random.default_rng(2)
+    distinct = list(numpy.repeat(rng.integers(0, 2, (10, 1080, 240), dtype=numpy.uint8), 8, axis=2))
+    # 40 frames of 10 distinct ones, 0/1 and 0/255 alike
+    images = [distinct[i % 10] * (255 if i % 3 else 1) for i in range(40)]
+    n = len(images)
+    dmd.defsequence(images, [1000] * n, [0] * n, [0] * n, [0] * n, 0)
+    # one image of 10 planes instead of two
+    assert list(simulator.images) == [0]
+    assert numpy.array_equal(erle.decode(simulator.images[0]), erle.merge(distinct))
+    for j in range(n):
+        entry = commands.LUT_DEFINITION.unpack(simulator.lut[j])
+        assert (entry.image_pattern_index, entry.bit_position) == (0, j % 10)
@@ -0,0 +1,95 @@
+import numpy
+import pytest
+from dlpyc900 import dmd, erle, DLPC900Simulator, Sequence
+
+
+def stripes(period, shift=0):
+    x = numpy.arange(1920)
+    return numpy.broadcast_to(((x + shift) // period) % 2, (1080, 1920)).astype(numpy.uint8)
+
+
+def test_sequence_packing():
+    seq = Sequence()
+    for cycle in range(3):
+        for shift in range(4):
+            seq.add(stripes(8, shift) * 255, exposuretime=1000)
+    ramp = numpy.broadcast_to(numpy.arange(1920) % 256, (1080, 1920)).astype(numpy.uint8)
+    seq.add(ramp, bitdepth=8)
+    seq.add(ramp >> 4, bitdepth=4)
+    images, entries = seq.compile()
+    # 8 + 4 + 4 binary bits fit in a single image
+    assert len(images) == 1 and len(entries) == 14
+    # repeated frames share their slot
+    assert [(e['image_pattern_index'], e['bit_position']) for e in entries[:4]] == [(e['image_pattern_index'], e['bit_position']) for e in entries[4:8]]
+    # bit positions count patterns of the frame's bit depth: the 4-bit frame in bits 8-11 is pattern 2
+    positions = {(e['bitdepth'], e['bit_position']) for e in entries}
+    assert positions == {(8, 0), (4, 2), (1, 12), (1, 13), (1, 14), (1, 15)}
+    merged = erle.merge(images[0])
+    assert numpy.array_equal(merged & 0xFF, ramp)
+    assert numpy.array_equal((merged >> 8) & 0xF, ramp >> 4)
+    with pytest.raises(ValueError):
+        seq.add(ramp, bitdepth=4)
+    # eight 3-bit frames fill one image, some across two color bytes
+    seq = Sequence()
+    for shift in range(8):
+        seq.add((ramp + shift) % 8, bitdepth=3)
+    images, entries = seq.compile()
+    assert len(images) == 1 and [e['bit_position'] for e in entries] == list(range(8))
+    merged = erle.merge(images[0])
+    assert numpy.array_equal((merged >> 6) & 7, (ramp + 2) % 8)
+
+
+def test_sequence_upload():
+    simulator = DLPC900Simulator()
+    device = dmd(simulator)
+    seq = Sequence()
+    for i in range(30):
+        seq.add(stripes(i + 2), exposuretime=500, darktime=100)
+    seq.add(stripes(2))
+    images, entries = seq.upload(device)
+    assert len(images) == 2 and len(images[1]) == 6
+    assert simulator.lut_config == (31, 0)
+    assert simulator.sequencer == 2
+    # images are loaded in reverse order
+    loads = [payload[0] for command, payload in simulator.commands if command == 0x1A2A]
+    assert loads == [1, 0]
+    merged, planes = erle.decode(simulator.images[entries[29]['image_pattern_index']], split_images=True)
+    assert numpy.array_equal(planes[entries[29]['bit_position']], stripes(31))
+    assert entries[30]['bit_position'] == entries[0]['bit_position']
+    assert seq.report['frames'] == 31 and seq.report['unique_frames'] == 30
+    assert seq.report['images_saved'] == 0 and seq.report['bytes_saved'] > 0
+    # the report takes the sizes of the upload, every image is encoded once, in the upload pipeline
+    device.encode_cache = None
+    encoded = []
+    encode_pattern = device.encode_pattern
+    device.encode_pattern = lambda halves: encoded.append(encode_pattern(halves)) or encoded[-1]
+    images, entries = seq.upload(device)
+    assert len(encoded) == len(images)
+    assert seq.report['bytes'] == sum(length for data, length in encoded)
+
+
+def test_sequence_deduplication_report():
+    device = dmd(DLPC900Simulator())
+    seq = Sequence()
+    for cycle in range(4):
+        for shift in range(12):
+            seq.add(stripes(12, shift))
+    images, entries = seq.upload(device)
+    assert len(images) == 1
+    assert seq.report['images_saved'] == 1
+    assert seq.report['bytes'] + seq.report['bytes_saved'] == sum(erle.encode(image)[1] for image in seq.compile(deduplicate=False)[0])
+
+
+def test_sequence_optimize_placement():
+    horizontal = [numpy.ascontiguousarray(stripes(i + 2).T[:1080, :1080].repeat(2, axis=1)[:, :1920]) for i in range(24)]
+    seq = Sequence()
+    for i in range(24):
+        seq.add(stripes(i + 2))
+        seq.add(horizontal[i])
+    plain = seq.compile()[0]
+    images, entries = seq.compile(optimize=True)
+    assert seq.placement['estimated_bytes_after'] < seq.placement['estimated_bytes_before']
+    assert sum(erle.encode(image)[1] for image in images) < sum(erle.encode(image)[1] for image in plain)
+    # every frame is still where its LUT entry says
+    for (frame, settings), entry in zip(seq.frames, entries):
+        assert images[entry['image_pattern_index']][entry['bit_position']] is frame